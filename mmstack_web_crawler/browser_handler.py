@@ -1,5 +1,7 @@
+import time
 import asyncio
 import uuid
+import psutil
 from io import BytesIO
 from playwright.async_api import async_playwright
 from playwright._impl._errors import (
@@ -9,21 +11,53 @@ from playwright._impl._errors import (
 
 from PIL import Image
 
+from mmstack_web_crawler.timing import StageTimer
+
+
+# Records the time of the last DOM mutation that can change what a page looks like
+SETTLE_OBSERVER_JS = """
+() => {
+    if (window.__settle) return;
+    const state = window.__settle = {lastMutation: performance.now()};
+    new MutationObserver(() => { state.lastMutation = performance.now(); }).observe(document, {
+        subtree: true, childList: true, characterData: true, attributes: true, attributeFilter: ['src', 'srcset', 'style', 'hidden'],
+    });
+}
+"""
+
+SETTLE_PROBE_JS = """
+() => {
+    const state = window.__settle || {lastMutation: 0};
+    return {
+        sinceMutation: (performance.now() - state.lastMutation) / 1000,
+        scrollHeight: document.documentElement.scrollHeight,
+        pendingImages: Array.from(document.images).filter(img => !img.complete).length,
+    };
+}
+"""
+
 
 class ChromeHandler:
-    def __init__(self, width=1920, height=1080, wait_timeout=5000, logger=None, headless=False):
+    def __init__(self, width=1920, height=1080, wait_timeout=5000, logger=None, headless=False, max_pages=None,
+                 request_blocker=None, on_slot_freed=None):
         self.id = str(uuid.uuid4())  # Generate a unique ID for each crawler
         self.width = width
         self.height = height
         self.wait_timeout = wait_timeout
         self.headless = headless
+        self.playwright = None
         self.browser = None
         self.context = None
         self.page_handlers = {}  # A dictionary to hold PageHandler instances by ID
+        self.max_pages = max_pages  # Page slots, None for no limit
+        self.slot_freed = asyncio.Event()  # Set whenever a page gives its slot back
+        self.pid_warned = False  # the process tree of this browser could not be found
+        self.on_slot_freed = on_slot_freed  # Called whenever a page gives its slot back, e.g. to wake a pool
+        self.request_blocker = request_blocker  # RequestBlocker routing the requests of the context
         self.logger = logger
 
     async def build_driver(self):
-        playwright = await async_playwright().start()
+        playwright = self.playwright = await async_playwright().start()
         browser_args = [
             "--ignore-certificate-errors",
             "--disable-logging",
@@ -36,6 +70,8 @@ class ChromeHandler:
             "--disk-cache-size=0",
             "--log-level=3",
             "--silent",
+            # Ignored by Chromium; tells this handler's browser process apart, see driver_pid()
+            f"--mmstack-crawler-id={self.id}",
         ]
 
         self.browser = await playwright.chromium.launch(headless=self.headless, args=browser_args)
@@ -43,6 +79,8 @@ class ChromeHandler:
             user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
             viewport={"width": self.width, "height": self.height}
         )
+        if self.request_blocker:
+            await self.request_blocker.install(self.context)
 
         if self.logger:
             self.logger.info(f"Crawler {self.id} initialized with headless={self.headless}")
@@ -59,6 +97,9 @@ class ChromeHandler:
                 await self.context.close()
             if self.browser:
                 await self.browser.close()
+            if self.playwright:
+                # Stop the driver too, or every restart leaves a node process behind
+                await self.playwright.stop()
         except Exception as e:
             if self.logger:
                 self.logger.error(f"Crawler {self.id} encountered an error while shutting down: {e}")
@@ -74,6 +115,10 @@ class ChromeHandler:
         """Helper function to safely remove a page from the dictionary."""
         if page_id in self.page_handlers:
             del self.page_handlers[page_id]
+            # Wake up whoever waits for a free slot
+            self.slot_freed.set()
+            if self.on_slot_freed:
+                self.on_slot_freed()
 
     # Async context manager methods
     async def __aenter__(self):
@@ -83,13 +128,18 @@ class ChromeHandler:
     async def __aexit__(self, exc_type, exc, tb):
         await self.close()
 
-    async def new_page(self, context=None):
+    async def new_page(self, context=None, timer=None):
         if self.context:
-            page_handler = PageHandler(self, None, self.logger) 
+            page_handler = PageHandler(self, None, self.logger, timer=timer)
             # Take the spot to avoid the worker pulling too many tasks!
             self.page_handlers[page_handler.id] = page_handler  # Placeholder to reserve the spot
             # Wait for the new page to be created
-            new_page = await self.context.new_page()
+            try:
+                new_page = await self.context.new_page()
+            except BaseException:
+                # Give the spot back if creating the page failed or was cancelled
+                self._remove_page(page_handler.id)
+                raise
             page_handler.set_page(new_page)
             assert page_handler.page is not None
             return page_handler
@@ -99,21 +149,115 @@ class ChromeHandler:
     def count_pages(self):
         return len(self.page_handlers)
 
+    def free_slots(self):
+        if self.max_pages is None:
+            return None
+        return max(0, self.max_pages - len(self.page_handlers))
+
+    async def wait_for_capacity(self):
+        """Wait until a page slot is free, waking up as soon as a page closes."""
+        while self.max_pages is not None and len(self.page_handlers) >= self.max_pages:
+            self.slot_freed.clear()
+            await self.slot_freed.wait()
+
+    def driver_pid(self):
+        """Pid of the root of this handler's browser process tree.
+
+        That is the Playwright driver, read from a private attribute of Playwright.
+        If it is missing, the Chromium process launched by this handler is looked up
+        instead. Returns None, with a warning the first time, if neither is found.
+        """
+        try:
+            return self.playwright._connection._transport._proc.pid
+        except AttributeError:
+            pass
+        pid = self.browser_pid()
+        if pid is None and not self.pid_warned:
+            self.pid_warned = True
+            message = f"Crawler {self.id}: browser process not found, its memory is not monitored"
+            if self.logger:
+                self.logger.warning(message)
+            else:
+                print(message)
+        return pid
+
+    def browser_pid(self):
+        """Pid of the Chromium process launched by this handler, found by its command line."""
+        marker = f"--mmstack-crawler-id={self.id}"
+        for process in psutil.Process().children(recursive=True):
+            try:
+                if marker in process.cmdline():
+                    return process.pid
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        return None
+
 
 class PageHandler:
-    def __init__(self, browser_handler, page, logger=None):
+    def __init__(self, browser_handler, page, logger=None, timer=None):
         self.id = str(uuid.uuid4())  # Generate a unique ID for each page
         self.browser_handler = browser_handler  # The ChromeHandler instance
         self.page = page
         self.logger = logger
+        self.timer = timer if timer is not None else StageTimer()  # Time spent per stage on this page
+        self.access_error = None  # "timeout" or "navigation_error" when access_url failed
+        self.requests = {}  # in-flight network requests -> start time
+        self.last_network_activity = time.monotonic()
     
     def set_page(self, page):
         self.page = page
+        if page is not None:
+            page.on("request", self._on_request_started)
+            page.on("requestfinished", self._on_request_done)
+            page.on("requestfailed", self._on_request_done)
+
+    def _on_request_started(self, request):
+        self.requests[request] = self.last_network_activity = time.monotonic()
+
+    def _on_request_done(self, request):
+        self.requests.pop(request, None)
+        self.last_network_activity = time.monotonic()
+
+    def pending_requests(self, max_age=3.0):
+        """Requests in flight, ignoring long-lived ones such as long polling or streams."""
+        now = time.monotonic()
+        return sum(1 for start in self.requests.values() if now - start < max_age)
+
+    async def wait_for_settle(self, quiet=0.5, timeout=5.0, poll_interval=0.1, max_request_age=3.0):
+        """Wait until the page has been quiet for `quiet` seconds, at most `timeout` seconds.
+
+        Quiet means no DOM mutation, no network request started or finished (apart
+        from requests older than `max_request_age`), no change of the scroll height
+        and no image still loading. Returns True if the page settled, False if the
+        cap was reached first.
+        """
+        deadline = time.monotonic() + timeout
+        await self.page.evaluate(SETTLE_OBSERVER_JS)
+        last_height = None
+        height_since = time.monotonic()
+        while True:
+            probe = await self.page.evaluate(SETTLE_PROBE_JS)
+            now = time.monotonic()
+            if probe["scrollHeight"] != last_height:
+                last_height = probe["scrollHeight"]
+                height_since = now
+            if (
+                probe["sinceMutation"] >= quiet
+                and probe["pendingImages"] == 0
+                and now - height_since >= quiet
+                and now - self.last_network_activity >= quiet
+                and self.pending_requests(max_request_age) == 0
+            ):
+                return True
+            if now >= deadline:
+                return False
+            await asyncio.sleep(min(poll_interval, max(0.0, deadline - now)))
 
     async def close(self):
         try:
             if self.page:
-                await self.page.close()  # Close the page
+                with self.timer.span("close"):
+                    await self.page.close()  # Close the page
                 if self.logger:
                     self.logger.info(f"Page {self.id} closed")
                 else:
@@ -148,24 +292,30 @@ class PageHandler:
 
         try:
             self.page.on('response', handle_response)
-            await self.page.goto(url, wait_until="load", timeout=timeout * 1000)  # or "networkidle"
+            with self.timer.span("goto"):
+                await self.page.goto(url, wait_until="load", timeout=timeout * 1000)  # or "networkidle"
         except TimeoutError:
             if self.logger:
                 self.logger.info(f"Timed out while accessing URL: {url}")
+            self.access_error = "timeout"
             return None
         except PlaywrightError as e:
             if self.logger:
                 self.logger.error(f"Error accessing URL: {url} - {e}")
+            self.access_error = "navigation_error"
             return None
 
         return response_code
 
     async def dump_html(self):
-        return await self.page.content()
+        with self.timer.span("content"):
+            return await self.page.content()
 
     async def screenshot(self):
-        screenshot_bytes = await self.page.screenshot()
-        image = Image.open(BytesIO(screenshot_bytes))
+        with self.timer.span("screenshot"):
+            screenshot_bytes = await self.page.screenshot()
+        with self.timer.span("screenshot_decode"):
+            image = Image.open(BytesIO(screenshot_bytes))
         return image
 
     async def get_scroll_position(self):
@@ -177,6 +327,10 @@ class PageHandler:
         await self.page.evaluate(f"window.scrollTo({scroll_x}, {scroll_y})")
 
     async def extend_to_full_height(self):
+        with self.timer.span("extend_to_full_height"):
+            await self._extend_to_full_height()
+
+    async def _extend_to_full_height(self):
         full_page_height = await self.page.evaluate("document.documentElement.scrollHeight")
         full_page_height = min(full_page_height, 16384)  # Limit the height
             
@@ -0,0 +1,263 @@
+import asyncio
+from collections import deque
+
+from mmstack_web_crawler.crawler import MMStackWebCrawler
+from mmstack_web_crawler.memory import rss_slope
+
+# Launches tried by one recycle before the browser is given up on for a while
+RECYCLE_ATTEMPTS = 3
+# Seconds before a browser whose relaunch failed is recycled again
+RECYCLE_RETRY_DELAY = 60
+
+
+class PooledBrowser:
+    """One browser of a `BrowserPool`, with its load and recycling state."""
+
+    def __init__(self, index, crawler):
+        self.index = index
+        self.crawler = crawler
+        self.in_flight = 0  # pages submitted whose crawl has not finished yet
+        self.storing = 0  # finished crawls whose results are still being stored
+        self.started = 0  # pages submitted since the browser was (re)launched
+        self.draining = False  # takes no new pages until it has been recycled
+        self.recycle_reason = None  # why the browser should be recycled as soon as possible
+        self.closed = False  # closed by a recycle whose relaunch failed
+        self.retry_at = None  # loop time before which a failed recycle is not retried
+        self.rss = 0  # RSS of the browser's process tree at the last sample
+        self.rss_slope = 0.0  # growth of that RSS, in bytes per minute
+        self.rss_samples = deque()  # (timestamp, rss) within the memory window
+
+    def free_slots(self):
+        if self.draining or self.closed:
+            return 0
+        free_slots = self.crawler.max_pages - self.in_flight
+        # Pages whose close is still pending after their crawl hold their slot too
+        handler_slots = self.crawler.browser_handler.free_slots() if self.crawler.browser_handler else None
+        if handler_slots is not None:
+            free_slots = min(free_slots, handler_slots)
+        return max(0, free_slots)
+
+    def record_rss(self, now, rss, window):
+        self.rss = rss
+        self.rss_samples.append((now, rss))
+        while now - self.rss_samples[0][0] > window:
+            self.rss_samples.popleft()
+        self.rss_slope = rss_slope(self.rss_samples)
+
+    def to_dict(self):
+        return {
+            "index": self.index,
+            "in_flight": self.in_flight,
+            "storing": self.storing,
+            "pages_open": self.crawler.browser_handler.count_pages(),
+            "started": self.started,
+            "draining": self.draining,
+            "closed": self.closed,
+            "rss_bytes": self.rss,
+            "rss_slope": self.rss_slope,
+        }
+
+
+class BrowserPool:
+    """Several browsers in one worker process, recycled one at a time.
+
+    Pages go to the serving browser with the most free slots. A page holds its slot
+    until its crawl is done and its page closed; storing the result does not. A browser is drained
+    when a `MemoryGovernor` asks for it, or, if `restart_interval` is set, once it
+    has served that many pages: it takes no new pages, and when its last page
+    finishes it is closed and relaunched. Only one browser drains at
+    a time, so the others keep serving meanwhile and a restart no longer stalls the
+    whole worker behind its slowest page. If a relaunch keeps failing, the browser
+    stops draining, so another one can, and is recycled again after a delay.
+    """
+
+    def __init__(self, size=2, max_pages=50, restart_interval=0, logger=None, headless=True, **crawler_options):
+        self.size = size
+        # max_pages spread over the browsers, the first ones taking the remainder
+        self.pages_per_browser = [max(1, max_pages // size + (index < max_pages % size)) for index in range(size)]
+        self.restart_interval = restart_interval
+        self.crawler_options = crawler_options  # passed on to every MMStackWebCrawler
+        self.logger = logger
+        self.headless = headless
+        self.browsers = []
+        self.tasks = set()
+        self.capacity_changed = asyncio.Event()
+
+    def _log(self, message):
+        if self.logger:
+            self.logger.info(message)
+        else:
+            print(message)
+
+    def _new_crawler(self, index):
+        return MMStackWebCrawler(
+            logger=self.logger, headless=self.headless, max_pages=self.pages_per_browser[index],
+            on_slot_freed=self.capacity_changed.set, **self.crawler_options
+        )
+
+    async def start(self):
+        crawlers = [self._new_crawler(index) for index in range(self.size)]
+        await asyncio.gather(*(crawler.initialize() for crawler in crawlers))
+        self.browsers = [PooledBrowser(index, crawler) for index, crawler in enumerate(crawlers)]
+        self._log(f"Browser pool started with {self.size} browsers of {self.pages_per_browser} pages")
+
+    async def close(self):
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        for browser in self.browsers:
+            await browser.crawler.close()
+        self.browsers = []
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    # Capacity
+    def max_pages(self):
+        return sum(self.pages_per_browser[:len(self.browsers)])
+
+    def free_slots(self):
+        return sum(browser.free_slots() for browser in self.browsers)
+
+    def in_flight(self):
+        return sum(browser.in_flight for browser in self.browsers)
+
+    def pages_open(self):
+        return sum(browser.crawler.browser_handler.count_pages() for browser in self.browsers)
+
+    def draining_slots(self):
+        """Page slots of the browsers that take no new pages until they are recycled."""
+        return sum(browser.crawler.max_pages for browser in self.browsers if browser.draining or browser.closed)
+
+    def serving(self):
+        """Number of browsers that accept new pages."""
+        return sum(not (browser.draining or browser.closed) for browser in self.browsers)
+
+    async def wait_for_capacity(self):
+        while self.free_slots() == 0:
+            self.capacity_changed.clear()
+            await self.capacity_changed.wait()
+
+    def least_loaded(self):
+        candidates = [browser for browser in self.browsers if browser.free_slots() > 0]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda browser: (browser.free_slots(), -browser.in_flight))
+
+    # Placement
+    async def submit(self, run, after=None):
+        """Run `run(crawler)` on the least loaded browser, once one has a free slot.
+
+        `after(result)`, e.g. storing what was crawled, runs once `run` has returned
+        and its slot has been given back. Returns the asyncio task running both.
+        """
+        await self.wait_for_capacity()
+        browser = self.least_loaded()
+        browser.in_flight += 1
+        browser.started += 1
+        self._maybe_drain()
+        task = asyncio.create_task(self._run(browser, run, after))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _run(self, browser, run, after):
+        crawler = browser.crawler
+        try:
+            result = await run(crawler)
+        finally:
+            browser.in_flight -= 1
+            self.capacity_changed.set()
+            if browser.draining and browser.in_flight == 0:
+                # In its own task, so this result is stored without waiting for the relaunch
+                self._spawn(self.recycle(browser))
+        if after is None:
+            return result
+        browser.storing += 1
+        try:
+            return await after(result)
+        finally:
+            browser.storing -= 1
+
+    def request_recycle(self, browser, reason):
+        """Recycle a browser as soon as no other browser is draining."""
+        browser.recycle_reason = reason
+        self._maybe_drain()
+
+    def _maybe_drain(self):
+        """Start draining the browser that is most overdue for a restart, unless one already is."""
+        if any(browser.draining for browser in self.browsers):
+            return
+        now = asyncio.get_running_loop().time()
+        due = [
+            browser for browser in self.browsers
+            if (browser.retry_at is None or browser.retry_at <= now)
+            and (browser.recycle_reason or (self.restart_interval and browser.started >= self.restart_interval))
+        ]
+        if not due:
+            return
+        # Browsers flagged for their memory go first
+        browser = max(due, key=lambda browser: (browser.recycle_reason is not None, browser.started))
+        self.drain(browser)
+
+    def drain(self, browser):
+        browser.draining = True
+        reason = browser.recycle_reason or f"{browser.started} pages served"
+        self._log(f"Draining browser {browser.index}: {reason} ({browser.in_flight} in flight)")
+        if browser.in_flight == 0:
+            self._spawn(self.recycle(browser))
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _launch(self, index):
+        """Launch a crawler for a browser slot, retrying a few times; None if every launch failed."""
+        for attempt in range(1, RECYCLE_ATTEMPTS + 1):
+            crawler = self._new_crawler(index)
+            try:
+                await crawler.initialize()
+                return crawler
+            except Exception as e:
+                self._log(f"Failed to launch browser {index} (attempt {attempt}/{RECYCLE_ATTEMPTS}): {e}")
+                try:
+                    await crawler.close()
+                except Exception:
+                    pass
+                await asyncio.sleep(attempt)
+        return None
+
+    async def recycle(self, browser):
+        """Close a drained browser and launch a fresh one in its place."""
+        self._log(f"Restarting browser {browser.index}...")
+        try:
+            if not browser.closed:
+                await browser.crawler.close()
+                browser.closed = True
+            crawler = await self._launch(browser.index)
+        except Exception as e:
+            self._log(f"Error restarting browser {browser.index}: {e}")
+            crawler = None
+        if crawler is None:
+            # Let another browser drain meanwhile; this one stays due and is tried again later
+            browser.draining = False
+            browser.retry_at = asyncio.get_running_loop().time() + RECYCLE_RETRY_DELAY
+            asyncio.get_running_loop().call_later(RECYCLE_RETRY_DELAY, self._maybe_drain)
+            self._log(f"Browser {browser.index} could not be restarted, retrying in {RECYCLE_RETRY_DELAY}s")
+            self._maybe_drain()
+            return
+        browser.crawler = crawler
+        browser.closed = False
+        browser.retry_at = None
+        browser.started = 0
+        browser.recycle_reason = None
+        browser.rss_samples.clear()
+        browser.draining = False
+        self._log(f"Browser {browser.index} restarted")
+        self._maybe_drain()
+        self.capacity_changed.set()
@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import asyncio
+from bisect import bisect_left, bisect_right
+
+
+class IntervalSet:
+    """A set of non-negative integers stored as sorted, disjoint half-open intervals [start, end)."""
+
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        for start, end in intervals:
+            self.add_range(start, end)
+
+    def __len__(self):
+        return sum(end - start for start, end in zip(self.starts, self.ends))
+
+    def __contains__(self, value):
+        i = bisect_right(self.starts, value) - 1
+        return i >= 0 and value < self.ends[i]
+
+    def add(self, value):
+        self.add_range(value, value + 1)
+
+    def add_range(self, start, end):
+        if start >= end:
+            return
+        # Intervals that overlap or touch [start, end) are merged into one
+        lo = bisect_left(self.ends, start)
+        hi = bisect_right(self.starts, end)
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+        self.starts[lo:hi] = [start]
+        self.ends[lo:hi] = [end]
+
+    def gaps(self, start, end):
+        """Yield the (start, end) ranges within [start, end) that are not in the set."""
+        i = bisect_right(self.ends, start)
+        cursor = start
+        while cursor < end:
+            if i >= len(self.starts) or self.starts[i] >= end:
+                yield cursor, end
+                return
+            if self.starts[i] > cursor:
+                yield cursor, self.starts[i]
+            cursor = max(cursor, self.ends[i])
+            i += 1
+
+    def to_list(self):
+        return [[start, end] for start, end in zip(self.starts, self.ends)]
+
+
+class FileProgress:
+    """Completion state of the rows of one parquet file.
+
+    `watermark` is the length of the contiguous completed prefix; rows completed
+    beyond it are kept in an interval set so that a restart only re-issues gaps.
+
+    The file is identified by `fingerprint` (see `task_source.file_fingerprint`),
+    cached together with the size and mtime it was computed for. `checksum` is the
+    full-content MD5, only filled in when it was explicitly verified.
+    """
+
+    def __init__(self, fingerprint, num_rows, watermark=0, done=(), file_stat=None, checksum=None):
+        self.fingerprint = fingerprint
+        self.num_rows = num_rows
+        self.file_stat = file_stat
+        self.checksum = checksum
+        self.done = IntervalSet(done)
+        self.done.add_range(0, watermark)
+
+    @property
+    def watermark(self):
+        if self.done.starts and self.done.starts[0] == 0:
+            return self.done.ends[0]
+        return 0
+
+    def complete(self, row):
+        self.done.add(row)
+
+    def is_finished(self):
+        return self.watermark >= self.num_rows
+
+    def pending_ranges(self):
+        """Row ranges that still have to be crawled, starting from the watermark."""
+        return list(self.done.gaps(self.watermark, self.num_rows))
+
+    def num_pending(self):
+        return sum(end - start for start, end in self.pending_ranges())
+
+    def to_dict(self):
+        watermark = self.watermark
+        return {
+            "fingerprint": self.fingerprint,
+            "file_stat": self.file_stat,
+            "checksum": self.checksum,
+            "num_rows": self.num_rows,
+            "watermark": watermark,
+            "done": [interval for interval in self.done.to_list() if interval[0] >= watermark],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if "watermark" not in data:
+            # Old checkpoints only stored the MD5 and the index of the last task handed out
+            return cls(None, None, watermark=data["progress"], checksum=data["checksum"])
+        return cls(
+            data.get("fingerprint"),
+            data["num_rows"],
+            data["watermark"],
+            data["done"],
+            file_stat=data.get("file_stat"),
+            checksum=data.get("checksum"),
+        )
+
+
+def load_checkpoint(checkpoint_file):
+    """Load per-file progress from a JSON checkpoint. Returns {} if there is none."""
+    if not os.path.exists(checkpoint_file):
+        return {}
+    with open(checkpoint_file, "r") as f:
+        checkpoint = json.load(f)
+    return {parquet_file: FileProgress.from_dict(data) for parquet_file, data in checkpoint.items()}
+
+
+def save_checkpoint(checkpoint, checkpoint_file):
+    """Atomically write per-file progress."""
+    write_checkpoint_data({parquet_file: progress.to_dict() for parquet_file, progress in checkpoint.items()}, checkpoint_file)
+
+
+def write_checkpoint_data(data, checkpoint_file):
+    """Write serialized progress to a temporary file, then rename it over the old checkpoint."""
+    tmp_file = f"{checkpoint_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, checkpoint_file)
+
+
+async def write_in_thread(func, *args):
+    """Run a blocking write in a thread, and finish it even if the caller is cancelled.
+
+    Cancelling `asyncio.to_thread` does not stop the thread, so a later write could
+    interleave with it. The cancellation is only passed on once the write is done.
+    """
+    write = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        await asyncio.shield(write)
+    except asyncio.CancelledError:
+        await write
+        raise
+
+
+class CheckpointWriter:
+    """Persists the checkpoint from a background task instead of the request handlers.
+
+    Handlers only call `mark_dirty`. The writer re-serializes just the files that
+    changed since the last write, and hands the JSON encoding and the atomic write to
+    a thread. A write happens every `interval` seconds if anything changed, or as
+    soon as `max_changes` changes have accumulated. `flush` forces a write, e.g. on
+    shutdown. `on_saved(saved_at)` is called after each write with the time the
+    snapshot was taken.
+    """
+
+    def __init__(self, checkpoint, checkpoint_file, interval=100, max_changes=100, on_saved=None, on_write_time=None):
+        self.checkpoint = checkpoint
+        self.checkpoint_file = checkpoint_file
+        self.interval = interval
+        self.max_changes = max_changes
+        self.on_saved = on_saved
+        self.on_write_time = on_write_time
+
+        self.snapshots = {}  # parquet_file -> serialized progress as of the last write
+        self.dirty_files = set(checkpoint)
+        self.changes = 0
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+
+    def mark_dirty(self, parquet_file):
+        self.dirty_files.add(parquet_file)
+        self.changes += 1
+        if self.changes >= self.max_changes:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if self.dirty_files:
+                await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            saved_at = time.time()
+            for parquet_file in self.dirty_files:
+                self.snapshots[parquet_file] = self.checkpoint[parquet_file].to_dict()
+            self.dirty_files = set()
+            self.changes = 0
+
+            start = time.perf_counter()
+            await write_in_thread(write_checkpoint_data, dict(self.snapshots), self.checkpoint_file)
+            if self.on_write_time:
+                self.on_write_time(time.perf_counter() - start)
+            if self.on_saved:
+                self.on_saved(saved_at)
@@ -1,25 +1,51 @@
 import asyncio
 import uuid
 from io import BytesIO
+import numpy as np
 from PIL import Image, ImageDraw
 from playwright.async_api import async_playwright, Error as PlaywrightError
-from bs4 import BeautifulSoup
 import uuid
 
 from mmstack_web_crawler.browser_handler import ChromeHandler, PageHandler
 from mmstack_web_crawler.utils import mark_box_on_screenshot
+from mmstack_web_crawler.annotate import mark_boxes_on_screenshot
+from mmstack_web_crawler.timing import StageTimer
+from mmstack_web_crawler.dom_snapshot import capture_dom_snapshot, snapshot_to_html
+from mmstack_web_crawler.pruning import prune_html_by_viewports
+
+
+# Outcome classes of a crawl, reported to the publisher with each acknowledgement
+OUTCOME_OK = "ok"
+OUTCOME_HTTP_ERROR = "http_error"
+OUTCOME_TIMEOUT = "timeout"
+OUTCOME_NAVIGATION_ERROR = "navigation_error"
+OUTCOME_STORAGE_ERROR = "storage_error"
+OUTCOME_DEADLINE_EXCEEDED = "deadline_exceeded"
 
 
 class MMStackWebCrawler:
-    def __init__(self, logger=None, headless=True, max_pages=50):
+    def __init__(self, logger=None, headless=True, max_pages=50, crawl_timeout=90, close_timeout=5,
+                 settle_quiet=0.5, settle_timeout=5, request_blocker=None, capture_mode="snapshot", bbox_html=True,
+                 on_slot_freed=None):
         self.logger = logger
         self.headless = headless
         self.max_pages = max_pages
+        self.settle_quiet = settle_quiet  # seconds without activity after which a page is settled
+        self.settle_timeout = settle_timeout  # longest wait for a page to settle, in seconds
+        self.request_blocker = request_blocker  # aborts requests that do not affect the capture
+        self.capture_mode = capture_mode  # "snapshot" (CDP DOMSnapshot) or "mark" (bbox attributes set on the live page)
+        self.bbox_html = bbox_html  # keep the __bbox__ attributes in the HTML of snapshot captures
+        self.crawl_timeout = crawl_timeout  # end-to-end bound of one crawl, in seconds
+        self.close_timeout = close_timeout  # bound on closing a page after the deadline
+        self.on_slot_freed = on_slot_freed  # called whenever one of the browser's pages closes
 
         self.browser_handler = None
 
     async def initialize(self, headless=True):
-        self.browser_handler = ChromeHandler(width=1920, height=1080, wait_timeout=5000, logger=self.logger, headless=self.headless)
+        self.browser_handler = ChromeHandler(
+            width=1920, height=1080, wait_timeout=5000, logger=self.logger, headless=self.headless, max_pages=self.max_pages,
+            request_blocker=self.request_blocker, on_slot_freed=self.on_slot_freed,
+        )
         await self.browser_handler.build_driver()
 
     async def __aenter__(self):
@@ -93,29 +119,15 @@ class MMStackWebCrawler:
             return False
 
     def prune_html_by_visibility(self, html_content, viewport_bbox):
-        """Remove hidden elements from the HTML content."""
-        soup = BeautifulSoup(html_content, "html.parser")
-
-        view_top, view_left, view_bottom, view_right = viewport_bbox
-
-        def try_get_attr(element, attr):
-            try:
-                return element.get(attr)
-            except (KeyError, AttributeError):
-                return None
-
-        for element in soup.find_all():
-            real_bbox = try_get_attr(element, "__bbox__")
-            top, left, bottom, right = map(int, real_bbox.strip("()").split(",")) if real_bbox else (None, None, None, None)
-
-            if not all([top, left, bottom, right]):
-                continue
-            # check if the at least a part of the element is visible in the viewport: iou > 0
-            if float(top) < view_bottom and float(bottom) > view_top and float(left) < view_right and float(right) > view_left:
-                continue
-            else:
-                element.decompose()
-        return str(soup)
+        """Remove the elements outside a viewport from the HTML content.
+
+        `viewport_bbox` is (left, top, right, bottom), in the order of `__bbox__`.
+        """
+        return prune_html_by_viewports(html_content, [viewport_bbox])[0]
+
+    def prune_html_by_viewports(self, html_content, viewports):
+        """Prune the HTML content for several viewports, e.g. the tiles of a tall page, parsing it once."""
+        return prune_html_by_viewports(html_content, viewports)
     
     async def dump_ui_and_html_with_bbox(self, page_handler, mark_position=True):
         """Capture the UI screenshot and HTML content after the page is loaded."""
@@ -123,54 +135,151 @@ class MMStackWebCrawler:
         screenshot_image = await page_handler.screenshot()
 
         if mark_position:
-            await self.mark_all_bounding_boxes_in_body(page_handler)
+            with page_handler.timer.span("mark_bbox"):
+                await self.mark_all_bounding_boxes_in_body(page_handler)
             html_content = await page_handler.dump_html()
-            await self.erase_marks_in_body(page_handler)
+            with page_handler.timer.span("erase_bbox"):
+                await self.erase_marks_in_body(page_handler)
         else:
             html_content = await page_handler.dump_html()
 
         # Return both HTML and screenshot
         return html_content, screenshot_image
 
+    async def dump_ui_and_snapshot(self, page_handler):
+        """Capture the UI screenshot, the HTML and the table of its elements.
+
+        The DOM and its layout come from a single CDP DOMSnapshot call, so the live
+        page is not modified. The HTML has the `__bbox__` attributes of
+        `dump_ui_and_html_with_bbox` unless `bbox_html` is off.
+        """
+        screenshot_image = await page_handler.screenshot()
+
+        with page_handler.timer.span("dom_snapshot"):
+            snapshot = await capture_dom_snapshot(page_handler.page)
+        with page_handler.timer.span("snapshot_serialize"):
+            html_content, elements = await asyncio.to_thread(snapshot_to_html, snapshot, self.bbox_html)
+
+        return html_content, screenshot_image, elements
+
     # Crawling logic
     async def wait_for_capacity(self):
-        while True:
-            num_current_pages = self.browser_handler.count_pages()
-            if num_current_pages >= self.max_pages:
-                await asyncio.sleep(1)
-            else:
-                break
-
+        await self.browser_handler.wait_for_capacity()
 
     async def crawl(self, url, output_annotated_screenshot=False):
+        """Crawl a URL. Returns the crawled content, or None if the page could not be captured."""
+        return (await self.crawl_with_outcome(url, output_annotated_screenshot))["content"]
+
+    async def crawl_with_outcome(self, url, output_annotated_screenshot=False, timeout=None, timer=None):
+        """Crawl a URL and report how it went.
+
+        Returns a dict with the crawled `content` (None on failure), the `outcome`
+        class, the `http_status` of the main response and per-stage `timings` in seconds,
+        taken from `timer` (a new `StageTimer` by default). A `timer` passed in is not
+        finished, so that the caller can time what follows, e.g. storing the page; the
+        returned `timings` are its live dict.
+
+        The whole crawl is bounded by `timeout` seconds (`crawl_timeout` by default).
+        Past it, the crawl is cancelled, its page is force-closed so that its slot is
+        released, and the outcome is `deadline_exceeded`.
+        """
+        timeout = self.crawl_timeout if timeout is None else timeout
         await self.wait_for_capacity()
 
+        own_timer = timer is None
+        timer = StageTimer() if own_timer else timer
+        state = {"page_handler": None, "http_status": None}
+        crawl_task = asyncio.create_task(self._crawl(url, output_annotated_screenshot, state, timer))
+        try:
+            done, _ = await asyncio.wait({crawl_task}, timeout=timeout)
+        except asyncio.CancelledError:
+            crawl_task.cancel()
+            raise
+        if done:
+            result = crawl_task.result()
+            if own_timer:
+                timer.finish()
+            return result
+
+        self.logger.info(f"Deadline of {timeout}s exceeded while crawling {url}")
+        crawl_task.cancel()
+        await self._force_close(state["page_handler"])
+        # Give the cancelled crawl a moment to unwind, but never wait on it for long
+        done, _ = await asyncio.wait({crawl_task}, timeout=self.close_timeout)
+        if not done:
+            crawl_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return {
+            "content": None,
+            "outcome": OUTCOME_DEADLINE_EXCEEDED,
+            "http_status": state["http_status"],
+            "timings": timer.finish() if own_timer else timer.timings,
+        }
+
+    async def wait_for_settle(self, page_handler, url):
+        settled = await page_handler.wait_for_settle(quiet=self.settle_quiet, timeout=self.settle_timeout)
+        if not settled:
+            self.logger.info(f"{url} did not settle within {self.settle_timeout}s")
+        return settled
+
+    async def _force_close(self, page_handler):
+        """Close a page that is stuck, releasing its slot even if closing hangs."""
+        if page_handler is None:
+            return
         try:
-            async with await self.browser_handler.new_page(url) as page_handler:
-                response_code = await page_handler.access_url(url, timeout=15)
+            await asyncio.wait_for(page_handler.close(), self.close_timeout)
+        except asyncio.TimeoutError:
+            self.logger.error(f"Page {page_handler.id} did not close within {self.close_timeout}s")
+        finally:
+            self.browser_handler._remove_page(page_handler.id)
+
+    async def _crawl(self, url, output_annotated_screenshot, state, timer):
+        result = None
+        outcome = OUTCOME_OK
+        timings = timer.timings
+        try:
+            with timer.span("new_page"):
+                page_handler = await self.browser_handler.new_page(url, timer=timer)
+            async with page_handler:
+                state["page_handler"] = page_handler
+                response_code = state["http_status"] = await page_handler.access_url(url, timeout=15)
                 if response_code not in [200, 302]:
                     self.logger.info(f"Failed to access {url} with response code {response_code}")
-                    return None
-                await asyncio.sleep(5)
+                    outcome = page_handler.access_error or OUTCOME_HTTP_ERROR
+                    return {"content": None, "outcome": outcome, "http_status": response_code, "timings": timings}
+                with timer.span("settle_load"):
+                    await self.wait_for_settle(page_handler, url)
 
                 # Extend the page to full height based on content height
                 await page_handler.extend_to_full_height()
-                await asyncio.sleep(5)
-                html_content, screenshot_image = await self.dump_ui_and_html_with_bbox(page_handler, mark_position=True)
+                with timer.span("settle_resize"):
+                    await self.wait_for_settle(page_handler, url)
+                elements = None
+                if self.capture_mode == "snapshot":
+                    html_content, screenshot_image, elements = await self.dump_ui_and_snapshot(page_handler)
+                else:
+                    html_content, screenshot_image = await self.dump_ui_and_html_with_bbox(page_handler, mark_position=True)
                 result = {
                     "url": url,
                     "html": html_content,
                     "image": screenshot_image,
                 }
+                if elements is not None:
+                    result["elements"] = elements
 
                 if output_annotated_screenshot:
-                    result["annotated_image"] = mark_box_on_screenshot(screenshot_image, html_content)
+                    with timer.span("annotate"):
+                        if elements is not None:
+                            # The element table already holds the boxes, no HTML to parse
+                            boxes = np.column_stack([elements[column] for column in ("left", "top", "right", "bottom")])
+                            result["annotated_image"] = mark_boxes_on_screenshot(screenshot_image, boxes, elements["tag"])
+                        else:
+                            result["annotated_image"] = mark_box_on_screenshot(screenshot_image, html_content)
         except PlaywrightError as e:
             self.logger.info(f"Error while crawling {url}: {e}")
             result = None
-        
+            outcome = OUTCOME_NAVIGATION_ERROR
 
-        return result
+        return {"content": result, "outcome": outcome, "http_status": state["http_status"], "timings": timings}
 
         
     async def close(self):
@@ -0,0 +1,113 @@
+import os
+import math
+import struct
+import hashlib
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+# Query parameters that only track where a visitor came from, besides every utm_* one.
+# Generic names such as "ref" are left alone: sites also use them to select content.
+TRACKING_PARAMS = {
+    "gclid", "gbraid", "wbraid", "dclid", "fbclid", "msclkid", "yclid", "ttclid", "twclid", "li_fat_id",
+    "mc_cid", "mc_eid", "_ga", "_gl", "igshid",
+}
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def canonicalize_url(url):
+    """Reduce a URL to a key shared by URLs that lead to the same page.
+
+    The scheme, default port, fragment, trailing slash, tracking parameters and the
+    order of the remaining query parameters are ignored; the host is lowercased.
+    """
+    try:
+        parts = urlsplit(url.strip())
+        host = (parts.hostname or "").lower()
+        port = parts.port
+    except ValueError:
+        return url
+    if port is not None and port != DEFAULT_PORTS.get(parts.scheme.lower()):
+        host = f"{host}:{port}"
+    path = parts.path.rstrip("/")
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS and not key.lower().startswith("utm_")
+    )
+    key = f"//{host}{path}"
+    if query:
+        key += "?" + urlencode(query)
+    return key
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter over strings, which can be saved to and loaded from disk.
+
+    Sized for `capacity` items at a false positive rate of `error_rate`. Bit positions
+    come from double hashing a single BLAKE2b digest per item. Past its capacity the
+    false positive rate grows quickly, see `saturated`.
+    """
+
+    MAGIC = b"BLM1"
+
+    def __init__(self, capacity=50_000_000, error_rate=0.01, num_bits=None, num_hashes=None, bits=None, count=0):
+        if num_bits is None:
+            num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        if num_hashes is None:
+            num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        # A loaded filter only knows its size, which was chosen for this many items
+        self.capacity = capacity if capacity is not None else max(1, int(num_bits * math.log(2) / num_hashes))
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+        self.count = count
+
+    def saturated(self):
+        """True once the filter holds more items than it was sized for."""
+        return self.count > self.capacity
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def add(self, item):
+        """Add an item. Returns False if it was (probably) already present."""
+        added = False
+        bits = self.bits
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                added = True
+        self.count += added
+        return added
+
+    def to_bytes(self):
+        return self.MAGIC + struct.pack("<QQQ", self.num_bits, self.num_hashes, self.count) + bytes(self.bits)
+
+    @staticmethod
+    def write(data, path):
+        """Atomically write the output of `to_bytes` to `path`."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def save(self, path):
+        self.write(self.to_bytes(), path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            if f.read(4) != cls.MAGIC:
+                raise ValueError(f"{path} is not a saved Bloom filter")
+            num_bits, num_hashes, count = struct.unpack("<QQQ", f.read(24))
+            bits = bytearray(f.read())
+        return cls(capacity=None, num_bits=num_bits, num_hashes=num_hashes, bits=bits, count=count)
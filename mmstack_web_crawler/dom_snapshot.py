@@ -0,0 +1,161 @@
+import math
+from html import escape
+
+# Elements without an end tag
+VOID_ELEMENTS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr",
+}
+# Elements whose text is serialized as is
+RAW_TEXT_ELEMENTS = {"script", "style", "xmp", "iframe", "noembed", "noframes", "plaintext", "noscript"}
+
+ELEMENT_NODE = 1
+TEXT_NODE = 3
+CDATA_SECTION_NODE = 4
+COMMENT_NODE = 8
+DOCUMENT_NODE = 9
+DOCUMENT_TYPE_NODE = 10
+
+# Attributes copied to the element table, by column
+TABLE_ATTRIBUTES = {"href": "href", "alt": "alt", "aria_label": "aria-label", "title": "title"}
+TABLE_COLUMNS = ["tag", "path", "left", "top", "right", "bottom", "text"] + list(TABLE_ATTRIBUTES)
+
+
+async def capture_dom_snapshot(page):
+    """DOM tree and computed layout of a page in a single CDP `DOMSnapshot.captureSnapshot` call."""
+    cdp = await page.context.new_cdp_session(page)
+    try:
+        return await cdp.send("DOMSnapshot.captureSnapshot", {"computedStyles": []})
+    finally:
+        await cdp.detach()
+
+
+def _rare_flags(rare_data):
+    return set(rare_data["index"]) if rare_data else set()
+
+
+def _escape_attribute(value):
+    return value.replace("&", "&amp;").replace('"', "&quot;").replace("\xa0", "&nbsp;")
+
+
+def _escape_text(value):
+    return escape(value, quote=False).replace("\xa0", "&nbsp;")
+
+
+def _js_round(value):
+    # Math.round of the marking script: halves go up, where round() goes to even
+    return math.floor(value + 0.5)
+
+
+def _tag_name(node_name):
+    # HTML elements are reported upper case, foreign (SVG, MathML) ones keep their case
+    return node_name.lower() if node_name.isupper() else node_name
+
+
+def snapshot_to_html(snapshot, bbox_attribute=True, max_text_length=1000):
+    """Serialize the main document of a DOM snapshot like `page.content()` does.
+
+    Returns the HTML and the element table of the page: one row per element inside
+    <body> with a non-empty box, as columns (`TABLE_COLUMNS`) holding its
+    tag, its XPath, its absolute rounded `left`, `top`, `right` and `bottom`, its own
+    rendered text and its `href`, `alt`, `aria-label` and `title` attributes. With
+    `bbox_attribute`, these elements also get the `__bbox__="(left,top,right,bottom)"`
+    attribute that the marking script used to set.
+    """
+    strings = snapshot["strings"]
+    document = snapshot["documents"][0]
+    nodes = document["nodes"]
+    parents = nodes["parentIndex"]
+    node_types = nodes["nodeType"]
+    node_names = nodes["nodeName"]
+    node_values = nodes["nodeValue"]
+    attributes = nodes["attributes"]
+    # Shadow roots and pseudo elements are not part of the serialized DOM
+    skipped = _rare_flags(nodes.get("shadowRootType")) | _rare_flags(nodes.get("pseudoType"))
+
+    # Layout boxes of elements and of rendered text nodes
+    boxes = {}
+    layout = document["layout"]
+    for node_index, (x, y, width, height) in zip(layout["nodeIndex"], layout["bounds"]):
+        boxes.setdefault(node_index, (_js_round(x), _js_round(y), _js_round(x + width), _js_round(y + height)))
+
+    children = [[] for _ in parents]
+    for index, parent in enumerate(parents):
+        if parent >= 0 and index not in skipped:
+            children[parent].append(index)
+
+    table = {column: [] for column in TABLE_COLUMNS}
+    parts = []
+
+    def string(index):
+        return strings[index] if index >= 0 else ""
+
+    def own_text(index):
+        texts = [
+            string(node_values[child]) for child in children[index]
+            if node_types[child] == TEXT_NODE and child in boxes
+        ]
+        return " ".join(" ".join(texts).split())[:max_text_length]
+
+    def child_paths(index, path):
+        counts = {}
+        for child in children[index]:
+            if node_types[child] == ELEMENT_NODE:
+                tag = _tag_name(string(node_names[child]))
+                counts[tag] = counts.get(tag, 0) + 1
+                yield child, f"{path}/{tag}[{counts[tag]}]"
+            else:
+                yield child, path
+
+    # Iterative pre-order walk, so that deep DOMs do not hit the recursion limit
+    stack = [(0, False, False, "")]
+    while stack:
+        index, closing, in_body, path = stack.pop()
+        node_type = node_types[index]
+        if closing:
+            parts.append(f"</{_tag_name(string(node_names[index]))}>")
+            continue
+        if node_type == ELEMENT_NODE:
+            tag = _tag_name(string(node_names[index]))
+            attrs = attributes[index]
+            names = [string(attrs[i]) for i in range(0, len(attrs), 2)]
+            values = [string(attrs[i + 1]) for i in range(0, len(attrs), 2)]
+            rendered = [f' {name}="{_escape_attribute(value)}"' for name, value in zip(names, values)]
+            box = boxes.get(index)
+            if in_body and box is not None and box != (0, 0, 0, 0):
+                attribute_map = dict(zip(names, values))
+                table["tag"].append(tag)
+                table["path"].append(path)
+                table["left"].append(box[0])
+                table["top"].append(box[1])
+                table["right"].append(box[2])
+                table["bottom"].append(box[3])
+                table["text"].append(own_text(index))
+                for column, attribute in TABLE_ATTRIBUTES.items():
+                    table[column].append(attribute_map.get(attribute))
+                if bbox_attribute:
+                    rendered.append(f' __bbox__="({box[0]},{box[1]},{box[2]},{box[3]})"')
+            parts.append(f"<{tag}{''.join(rendered)}>")
+            if tag in VOID_ELEMENTS:
+                continue
+            stack.append((index, True, in_body, path))
+            child_in_body = in_body or tag == "body"
+            stack.extend(
+                (child, False, child_in_body, child_path)
+                for child, child_path in reversed(list(child_paths(index, path)))
+            )
+        elif node_type == TEXT_NODE:
+            parent_tag = _tag_name(string(node_names[parents[index]])) if parents[index] >= 0 else ""
+            text = string(node_values[index])
+            parts.append(text if parent_tag in RAW_TEXT_ELEMENTS else _escape_text(text))
+        elif node_type == CDATA_SECTION_NODE:
+            parts.append(f"<![CDATA[{string(node_values[index])}]]>")
+        elif node_type == COMMENT_NODE:
+            parts.append(f"<!--{string(node_values[index])}-->")
+        elif node_type == DOCUMENT_TYPE_NODE:
+            parts.append(f"<!DOCTYPE {string(node_names[index])}>")
+        elif node_type == DOCUMENT_NODE:
+            stack.extend(
+                (child, False, False, child_path) for child, child_path in reversed(list(child_paths(index, path)))
+            )
+
+    return "".join(parts), table
@@ -0,0 +1,52 @@
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# One row per element with a box; see `dom_snapshot.snapshot_to_html`
+SCHEMA = pa.schema([
+    ("tag", pa.string()),
+    ("path", pa.string()),
+    ("left", pa.int32()),
+    ("top", pa.int32()),
+    ("right", pa.int32()),
+    ("bottom", pa.int32()),
+    ("text", pa.string()),
+    ("href", pa.string()),
+    ("alt", pa.string()),
+    ("aria_label", pa.string()),
+    ("title", pa.string()),
+])
+
+BOX_COLUMNS = ["left", "top", "right", "bottom"]
+
+
+def to_arrow(table):
+    """Arrow table of an element table given as a dict of columns."""
+    return pa.Table.from_pydict(table, schema=SCHEMA)
+
+
+def write_element_table(table, path):
+    """Write an element table to a parquet file, atomically."""
+    tmp_path = f"{path}.tmp"
+    pq.write_table(to_arrow(table), tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+
+
+def load_element_table(path, columns=None):
+    """Load an element table saved next to a screenshot.
+
+    Returns a dict with `boxes`, an (N, 4) int32 array of left, top, right and
+    bottom, and one NumPy array per other requested column (object arrays for
+    strings, with None for missing attributes). No HTML has to be parsed.
+    """
+    wanted = [column for column in (columns or SCHEMA.names) if column not in BOX_COLUMNS]
+    arrow_table = pq.read_table(path, columns=BOX_COLUMNS + wanted)
+    result = {
+        "boxes": np.stack(
+            [arrow_table.column(column).to_numpy() for column in BOX_COLUMNS], axis=1
+        ).astype(np.int32, copy=False),
+    }
+    for column in wanted:
+        result[column] = arrow_table.column(column).to_numpy(zero_copy_only=False)
+    return result
@@ -0,0 +1,173 @@
+import re
+from urllib.parse import urlsplit
+
+from playwright._impl._errors import Error as PlaywrightError
+
+
+# Ad and analytics domains, matched together with their subdomains
+AD_ANALYTICS_DOMAINS = {
+    "doubleclick.net", "googlesyndication.com", "googleadservices.com", "google-analytics.com",
+    "googletagmanager.com", "googletagservices.com", "adservice.google.com", "connect.facebook.net",
+    "amazon-adsystem.com", "adnxs.com", "criteo.com", "criteo.net", "taboola.com", "outbrain.com",
+    "scorecardresearch.com", "quantserve.com", "moatads.com", "pubmatic.com", "rubiconproject.com",
+    "openx.net", "casalemedia.com", "advertising.com", "adsrvr.org", "bidswitch.net", "smartadserver.com",
+    "yieldmo.com", "hotjar.com", "mixpanel.com", "segment.io", "segment.com", "nr-data.net",
+    "clarity.ms", "bat.bing.com", "analytics.tiktok.com", "ads-twitter.com", "static.ads-twitter.com",
+    "adform.net", "mathtag.com", "demdex.net", "omtrdc.net", "chartbeat.com", "krxd.net",
+}
+
+# Resource types that never change the layout of a screenshot
+NON_VISUAL_TYPES = {"websocket", "eventsource", "manifest", "texttrack"}
+
+# URL patterns (by file extension) of the resource types that can be matched before
+# a request is sent; the other types are only known once a request is routed.
+TYPE_URL_PATTERNS = {
+    "media": r"\.(mp4|m4v|webm|ogv|ogg|mov|mp3|m4a|wav|flac|aac|opus|m3u8|mpd)",
+    "texttrack": r"\.(vtt|srt)",
+    "manifest": r"(\.webmanifest|/manifest\.json)",
+    "font": r"\.(woff2?|ttf|otf|eot)",
+}
+
+# Types never seen by a route handler (websockets) or without a recognisable URL
+# (event streams); they are only blocked when every request is routed anyway.
+UNMATCHABLE_TYPES = {"websocket", "eventsource"}
+
+# Blocking policies, selected per run with --block_policy
+POLICY_PRESETS = {
+    "off": {},
+    "trackers": {
+        "block_domains": True,
+    },
+    "balanced": {
+        "block_domains": True,
+        "blocked_types": NON_VISUAL_TYPES,
+        "size_capped_types": {"media"},
+        "max_bytes": 2 * 2 ** 20,
+    },
+    "aggressive": {
+        "block_domains": True,
+        "blocked_types": NON_VISUAL_TYPES | {"media", "font"},
+        "size_capped_types": {"image"},
+        "max_bytes": 1 * 2 ** 20,
+    },
+}
+
+
+class InterceptionStats:
+    """Requests and bytes blocked by every `RequestBlocker` of this process."""
+
+    def __init__(self):
+        self.allowed = 0
+        self.blocked = {}  # reason -> number of requests
+        self.blocked_bytes = 0  # announced size of the requests blocked by size
+
+    def to_dict(self):
+        return {
+            "allowed_requests": self.allowed,
+            "blocked_requests": sum(self.blocked.values()),
+            "blocked_by_reason": dict(self.blocked),
+            "blocked_bytes": self.blocked_bytes,
+        }
+
+
+# Aggregate of all blockers of this process
+interception_stats = InterceptionStats()
+
+
+class RequestBlocker:
+    """Aborts requests of a browser context that cannot change what a capture shows.
+
+    Requests are aborted by resource type, when their host is on the domain
+    blocklist, or, for `size_capped_types`, when a HEAD probe announces a response
+    larger than `max_bytes`; the body itself is only ever loaded by the browser.
+    Only requests to blocked hosts or with the file extension of a blocked or capped
+    type are routed through Python, unless a type cannot be told from its URL.
+    Stylesheets, scripts, documents and images (except oversized ones with the
+    "aggressive" preset) are left alone, so the layout is kept.
+    """
+
+    def __init__(self, block_domains=False, blocked_types=(), size_capped_types=(), max_bytes=None,
+                 extra_domains=(), stats=interception_stats, logger=None):
+        self.domains = (set(AD_ANALYTICS_DOMAINS) if block_domains else set()) | set(extra_domains)
+        self.blocked_types = set(blocked_types)
+        self.size_capped_types = set(size_capped_types) if max_bytes else set()
+        self.max_bytes = max_bytes
+        self.stats = stats
+        self.logger = logger
+
+    @classmethod
+    def from_preset(cls, name, extra_domains=(), logger=None):
+        return cls(**POLICY_PRESETS[name], extra_domains=extra_domains, logger=logger)
+
+    def enabled(self):
+        return bool(self.domains or self.blocked_types or self.size_capped_types)
+
+    def domain_pattern(self):
+        """Regex of the URLs whose host is a blocked domain or one of its subdomains."""
+        domains = "|".join(re.escape(domain) for domain in sorted(self.domains))
+        return re.compile(rf"^[a-z][a-z0-9+.-]*://([^/?#@]*@)?([^/?#:]*\.)?({domains})\.?(:\d+)?([/?#]|$)", re.IGNORECASE)
+
+    def route_pattern(self):
+        """Regex of the URLs the blocker may abort, or None if every request must be routed."""
+        types = (self.blocked_types | self.size_capped_types) - UNMATCHABLE_TYPES
+        if any(resource_type not in TYPE_URL_PATTERNS for resource_type in types):
+            return None
+        patterns = []
+        if self.domains:
+            patterns.append(self.domain_pattern().pattern)
+        if types:
+            extensions = "|".join(TYPE_URL_PATTERNS[resource_type] for resource_type in sorted(types))
+            patterns.append(rf"^[^?#]*({extensions})([?#]|$)")
+        if not patterns:
+            return None
+        return re.compile("|".join(f"({pattern})" for pattern in patterns), re.IGNORECASE)
+
+    async def install(self, context):
+        """Route the requests of a browser context that this blocker may abort through it."""
+        pattern = self.route_pattern()
+        # Matched by the driver, so other requests never reach Python
+        await context.route(pattern if pattern is not None else "**/*", self.handle)
+
+    def blocked_domain(self, url):
+        host = (urlsplit(url).hostname or "").lower()
+        while host:
+            if host in self.domains:
+                return True
+            _, _, host = host.partition(".")
+        return False
+
+    async def announced_size(self, route):
+        """Content-Length of a HEAD request for the routed URL, or None if unknown."""
+        try:
+            response = await route.fetch(method="HEAD", max_redirects=5, timeout=5000)
+            return int(response.headers["content-length"])
+        except (PlaywrightError, KeyError, ValueError):
+            return None
+
+    async def handle(self, route):
+        request = route.request
+        reason = None
+        size = 0
+        try:
+            if request.resource_type in self.blocked_types:
+                reason = "type"
+            elif self.domains and self.blocked_domain(request.url):
+                reason = "domain"
+            elif request.resource_type in self.size_capped_types:
+                # Decided from the headers only, the browser then loads the body itself
+                announced = await self.announced_size(route)
+                if announced is not None and announced > self.max_bytes:
+                    reason = "size"
+                    size = announced
+
+            if reason is None:
+                self.stats.allowed += 1
+                await route.continue_()
+            else:
+                self.stats.blocked[reason] = self.stats.blocked.get(reason, 0) + 1
+                self.stats.blocked_bytes += size
+                await route.abort("blockedbyclient")
+        except PlaywrightError as e:
+            # The page may have been closed in the meantime
+            if self.logger:
+                self.logger.debug(f"Error while routing {request.url}: {e}")
@@ -1,20 +1,89 @@
 import os
-import json
 import time
 import hashlib
 import logging
 import httpx
-import pandas as pd
 import asyncio
 from pathlib import Path
 import argparse
 from tqdm.asyncio import tqdm
-from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi import FastAPI, Request, BackgroundTasks, WebSocket, WebSocketDisconnect
 from fastapi.responses import JSONResponse, Response
 import uvicorn
+from contextlib import asynccontextmanager
+
+from mmstack_web_crawler.lease import LeaseManager, retry_delay, task_key
+from mmstack_web_crawler.checkpoint import FileProgress, CheckpointWriter, load_checkpoint, write_in_thread
+from mmstack_web_crawler.task_source import ParquetTaskSource, count_rows, file_fingerprint
+from mmstack_web_crawler.scheduler import HostScheduler
+from mmstack_web_crawler.ledger import TaskLedger
+from mmstack_web_crawler.dedup import BloomFilter, canonicalize_url
+from mmstack_web_crawler.registry import WorkerRegistry
+from mmstack_web_crawler import metrics
+
+
+async def reap_expired_leases():
+    """Periodically re-queue tasks whose worker did not ack them in time."""
+    while True:
+        await asyncio.sleep(args.reap_interval)
+        expired, abandoned = lease_manager.reap()
+        metrics.tasks_expired.inc(len(expired))
+        metrics.tasks_abandoned.inc(len(abandoned))
+        for task in expired:
+            scheduler.release(task)
+        abandoned_keys = {task_key(task) for task in abandoned}
+        ledger.record_states([task for task in expired if task_key(task) not in abandoned_keys], "pending")
+        ledger.record_states(abandoned, "failed")
+        for task in abandoned:
+            logging.warning(f"Giving up on task {task['id']} ({task['url']}) after {args.max_attempts} attempts.")
+            mark_row_done(task)
+            task_result_callback(failed=True)
+        if expired:
+            notify_work()
+        stop_if_finished()
+        for worker in registry.evict_stale():
+            logging.warning(f"Worker {worker} stopped sending heartbeats.")
+            metrics.remove_worker(worker)
+
+
+work_available = asyncio.Event()
+def notify_work():
+    """Wake up the push channels waiting for tasks, e.g. after acks or re-queued leases."""
+    global work_available
+    work_available.set()
+    work_available = asyncio.Event()
+
+
+async def save_seen_urls():
+    """Write the filter of crawled URLs to disk, off the event loop."""
+    await write_in_thread(BloomFilter.write, seen_urls.to_bytes(), args.dedup_file)
+
+
+async def save_seen_urls_periodically():
+    while True:
+        await asyncio.sleep(args.dedup_save_interval)
+        await save_seen_urls()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    reaper = asyncio.create_task(reap_expired_leases())
+    checkpoint_task = asyncio.create_task(checkpoint_writer.run())
+    dedup_task = asyncio.create_task(save_seen_urls_periodically())
+    yield
+    background_tasks = [reaper, checkpoint_task, dedup_task]
+    for task in background_tasks:
+        task.cancel()
+    # A cancelled periodic write finishes first, so it cannot overwrite the final one
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await checkpoint_writer.flush()
+    await save_seen_urls()
+    print(f"Skipped {num_duplicates} duplicate URLs.")
+    ledger.close()
+
 
 # FastAPI app for worker communication
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 pending_tasks = {}
 
@@ -22,127 +91,453 @@ def calculate_checksum(file_path):
     """Calculate the checksum of a file."""
     hash_md5 = hashlib.md5()
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(1 << 20), b""):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
 
-def save_checkpoint(checkpoint_data, checkpoint_file):
-    """Save progress checkpoint to a JSON file."""
-    with open(checkpoint_file, "w") as f:
-        json.dump(checkpoint_data, f)
+num_failed = 0
+def task_result_callback(failed=False):
+    global num_failed
+    num_failed += failed
+    pbar.update(1)
+    pbar.set_postfix({"Working": len(lease_manager), "Failed": num_failed, "Duplicates": num_duplicates})
+    pbar.refresh()
 
 
-def parquet_data_generator(parquet_files_with_indices):
-    for parquet_file, df, start_index in parquet_files_with_indices:
-        for index in range(start_index, len(df)):
-            yield parquet_file, index, df.iloc[index]
+def identify_file(real_path, cached=None, verify_checksum=False):
+    """Fingerprint a parquet file and check whether it is the file `cached` describes.
 
+    The footer fingerprint is reused from the checkpoint while the file's size and
+    mtime are unchanged. The full MD5 is only computed with `verify_checksum`, or to
+    migrate entries of old checkpoints which only stored the MD5.
 
-def task_result_callback():
-    pbar.update(1)
-    pbar.set_postfix({"Working": len(tasks_in_progress)})
-    pbar.refresh()
+    Returns (fingerprint, file_stat, checksum, matches).
+    """
+    stat = os.stat(real_path)
+    file_stat = [stat.st_size, stat.st_mtime_ns]
+    if cached is not None and cached.fingerprint and cached.file_stat == file_stat:
+        fingerprint = cached.fingerprint
+    else:
+        fingerprint = file_fingerprint(real_path)
+
+    checksum = cached.checksum if cached is not None else None
+    if cached is None:
+        matches = False
+    elif cached.fingerprint is None:
+        checksum = calculate_checksum(real_path)
+        matches = checksum == cached.checksum
+    else:
+        matches = cached.fingerprint == fingerprint
+
+    if verify_checksum:
+        checksum = calculate_checksum(real_path)
+        if matches and cached.checksum is not None and cached.checksum != checksum:
+            print(f"Checksum mismatch for {real_path}, discarding its checkpoint")
+            matches = False
+
+    return fingerprint, file_stat, checksum, matches
 
 
-def load_from_checkpoint(parquet_folder, checkpoint_file):
+def load_from_checkpoint(parquet_folder, checkpoint_file, verify_checksum=False, ledger=None):
     # Load checkpoint
-    if os.path.exists(checkpoint_file):
-        with open(checkpoint_file, "r") as f:
-            checkpoint = json.load(f)
-    else:
-        checkpoint = {}
+    checkpoint = load_checkpoint(checkpoint_file)
+
+    # Tasks that finished after the checkpoint was last written
+    finished_rows = {}
+    if ledger is not None:
+        checkpoint_at = float(ledger.get_meta("checkpoint_at", 0))
+        for parquet_file, row in ledger.finished_since(checkpoint_at):
+            finished_rows.setdefault(parquet_file, []).append(row)
 
     parquet_files = sorted([f for f in os.listdir(parquet_folder) if f.endswith('.parquet')])
     pending_data = []
     num_tasks = 0
     for parquet_file in parquet_files:
 
-        # Calculate the file checksum
+        # Identify the file from its metadata
         print(f"Loading file: {parquet_file}")
         real_path = os.path.join(parquet_folder, parquet_file)
-        checksum = calculate_checksum(real_path)
-        parquet = pd.read_parquet(real_path)
+        cached = checkpoint.get(parquet_file)
+        fingerprint, file_stat, checksum, matches = identify_file(real_path, cached, verify_checksum)
+
+        # Load progress or initialize checkpoint for the file
+        if matches:
+            progress = checkpoint[parquet_file]
+            if progress.num_rows is None or progress.file_stat != file_stat:
+                progress.num_rows = count_rows(real_path)
+            progress.fingerprint = fingerprint
+            progress.file_stat = file_stat
+            progress.checksum = checksum
+        else:
+            progress = FileProgress(fingerprint, count_rows(real_path), file_stat=file_stat, checksum=checksum)
+            checkpoint[parquet_file] = progress
+
+        # Catch up with the ledger, unless the file changed since it was recorded
+        if matches or cached is None:
+            for row in finished_rows.get(parquet_file, []):
+                progress.complete(row)
 
         # Skip finished files
-        if (
-            parquet_file in checkpoint and 
-            checkpoint[parquet_file]["checksum"] == checksum and
-            checkpoint[parquet_file]["progress"] == len(parquet)
-        ):
+        if progress.is_finished():
             print(f"Skipping finished file: {parquet_file}")
             continue
 
-        # Load progress or initialize checkpoint for the file
-        if parquet_file in checkpoint and checkpoint[parquet_file]["checksum"] == checksum:
-            start_index = checkpoint[parquet_file]["progress"]
-            print(f"Found checkpoint for file: {parquet_file}, will resume from index {start_index}")
-        else:
-            start_index = 0
-            checkpoint[parquet_file] = {"checksum": checksum, "progress": 0}
+        pending_ranges = progress.pending_ranges()
+        num_pending = sum(end - start for start, end in pending_ranges)
+        if progress.watermark > 0 or len(pending_ranges) > 1:
+            print(f"Found checkpoint for file: {parquet_file}, will resume {num_pending} rows from index {progress.watermark}")
 
-        num_tasks += len(parquet) - start_index
-        
-        # Append the file and start index pair for the generator
-        pending_data.append((parquet_file, parquet, start_index))
+        num_tasks += num_pending
+
+        # Append the file and its unfinished row ranges for the task source
+        pending_data.append((parquet_file, pending_ranges))
 
     print(f"Found {num_tasks} pending tasks.")
 
-    return parquet_data_generator(pending_data), checkpoint, num_tasks
+    return task_generator(ParquetTaskSource(parquet_folder, pending_data), checkpoint), checkpoint, num_tasks
+
+
+saturated_filters = set()
+def trust_filter(name, bloom):
+    """Whether matches of a dedup filter may drop rows; not once it holds more URLs than it was sized for."""
+    if not bloom.saturated():
+        return True
+    if name not in saturated_filters:
+        saturated_filters.add(name)
+        logging.warning(
+            f"The {name} URL filter holds {bloom.count} URLs, more than the {bloom.capacity} it was sized for. "
+            f"Its matches are no longer skipped as duplicates; raise --dedup_capacity."
+        )
+    return False
+
+
+num_duplicates = 0
+def dedup_tasks(tasks):
+    """Drop tasks whose URL was crawled in an earlier run or was already published in this one.
+
+    A filter past its capacity is still filled but no longer drops rows, since most
+    of its matches could be false positives.
+    """
+    global num_duplicates
+    for task in tasks:
+        key = canonicalize_url(task["url"])
+        if (key in seen_urls and trust_filter("seen", seen_urls)) or (not run_urls.add(key) and trust_filter("run", run_urls)):
+            num_duplicates += 1
+            metrics.duplicate_urls.inc()
+            mark_row_done(task)
+            task_result_callback()
+            continue
+        yield task
 
-last_save_time = time.time()
-def possibly_save_checkpoint(checkpoint, checkpoint_file):
-    global last_save_time
-    current_time = time.time()
-    if current_time - last_save_time > args.save_interval:
-        save_checkpoint(checkpoint, checkpoint_file)
 
-@app.get("/task")
-async def get_task(request: Request):
-    """Handle task request from worker."""
-    try:
-        parquet_file, index_in_file, task_data = next(data_loader)
-    except StopIteration:
+def task_generator(task_source, checkpoint):
+    for parquet_file, index_in_file, task_id, url in task_source:
+        # Rows restored from the ledger may have been finished since the source was planned
+        if index_in_file in checkpoint[parquet_file].done:
+            continue
+        yield {
+            "id": task_id,
+            "url": url,
+            "file": parquet_file,
+            "row": index_in_file,
+        }
+
+def restore_from_ledger():
+    """Re-queue the tasks that were in flight when the publisher last stopped."""
+    num_restored = 0
+    for task, attempts in ledger.unfinished():
+        progress = checkpoint.get(task["file"])
+        if progress is None or task["row"] in progress.done:
+            continue
+        lease_manager.restore(task, attempts)
+        num_restored += 1
+    if num_restored:
+        print(f"Restored {num_restored} in-flight tasks from the ledger.")
+
+
+def stop_if_finished():
+    """Shut the publisher down, through the lifespan so that progress is flushed, once every task is done.
+
+    Returns True if it is.
+    """
+    if len(lease_manager) > 0 or lease_manager.has_retries() or not scheduler.exhausted():
+        # In-flight tasks may still come back through the reaper, or hosts are throttled
+        return False
+    if not server.should_exit:
         print("All tasks completed.")
-        exit(0)
+        server.should_exit = True
+    return True
+
+
+def next_work_delay():
+    """Seconds until held back tasks may become eligible, at most --push_poll_interval."""
+    now = time.time()
+    # Times already past hold nothing back, e.g. when the registry granted no tasks
+    times = [t for t in (scheduler.next_eligible_at(), lease_manager.next_ready_at()) if t is not None and t > now]
+    return min([t - now for t in times] + [args.push_poll_interval])
+
+
+def lease_tasks(n, worker=None):
+    """Hand out up to n tasks, expired leases first, then fresh rows picked by the host scheduler.
+
+    The number of tasks is capped by what the worker registry grants the worker.
+    Retries obey the same per-host limits as fresh rows: ones held back by host
+    spacing wait until it ends, ones whose host is full stay at the front of the queue.
+    """
+    n = registry.grant(worker, n)
+    tasks = []
+    leases = []
+    held = []
+    now = time.time()
+    while len(tasks) < n:
+        task = lease_manager.next_retry(now)
+        if task is not None:
+            eligible_at = scheduler.eligible_at(task, now)
+            if eligible_at is None:
+                held.append(task)
+                continue
+            if eligible_at > now:
+                lease_manager.defer(task, eligible_at)
+                continue
+            scheduler.on_lease(task, now)
+        else:
+            task = scheduler.next_task()
+            if task is None:
+                break
+            if task_key(task) in lease_manager:
+                # Already handed out again after a restart
+                scheduler.release(task)
+                continue
+
+        leases.append(lease_manager.lease(task))
+        tasks.append(task)
+    lease_manager.hold(held)
+
+    ledger.record_leases(leases, worker)
+    registry.record_lease(worker, len(tasks))
+    metrics.tasks_leased.labels(worker=worker or "unknown").inc(len(tasks))
+    metrics.lease_batch_size.observe(len(tasks))
+    return tasks
+
+
+def mark_row_done(task):
+    """Record a task's row as finished in the checkpoint."""
+    checkpoint[task["file"]].complete(task["row"])
+    checkpoint_writer.mark_dirty(task["file"])
+
+
+def ack_key(ack):
+    """Key of the task an ack is for. Acks of older workers only carry the task id."""
+    if "file" in ack and "row" in ack:
+        return task_key(ack)
+    return lease_manager.find(ack["id"])
+
+
+def complete_task(ack, worker=None):
+    """Process one ack. Returns (task, state, outcome, http_status) for the ledger, or None."""
+    task_id = ack["id"]
+    key = ack_key(ack)
+    outcome = ack.get("outcome", "ok")
+    http_status = ack.get("http_status")
+    metrics.task_outcomes.labels(outcome=outcome).inc()
+    for stage, seconds in (ack.get("timings") or {}).items():
+        metrics.worker_stage_seconds.labels(stage=stage).observe(seconds)
+
+    # Transient failures are handed out again after a backoff
+    if outcome != "ok":
+        lease = lease_manager.leases.get(key)
+        if lease is None:
+            logging.warning(f"Received {outcome} for task {task_id} which is not leased. Maybe it timed out.")
+            metrics.unknown_acks.inc()
+            return None
+        delay = retry_delay(outcome, http_status, lease["attempt"])
+        if delay is not None and lease["attempt"] < lease_manager.max_attempts:
+            lease_manager.retry_later(key, delay)
+            scheduler.release(lease["task"])
+            metrics.tasks_retried.labels(outcome=outcome).inc()
+            return lease["task"], "pending", outcome, http_status
+
+    # Release the lease
+    lease = lease_manager.ack(key)
+    if lease is None:
+        logging.warning(f"Received acknowledgment for unknown task {task_id}. Maybe it timed out.")
+        metrics.unknown_acks.inc()
+        return None
 
-    uuid = task_data.name
-    task = {
-        "id": uuid,
-        "url": task_data["url"],
-    }
+    metrics.tasks_acked.labels(worker=worker or "unknown").inc()
+    if "timestamp" in lease:
+        metrics.lease_age.observe(time.time() - lease["timestamp"])
 
-    tasks_in_progress[uuid] = {
-        "timestamp": time.time(),
-        "id": uuid,
-        "url": task_data["url"],
-    }
+    # Successes and permanent failures are final, also for later runs
+    if outcome == "ok":
+        seen_urls.add(canonicalize_url(lease["task"]["url"]))
+    scheduler.release(lease["task"])
+    mark_row_done(lease["task"])
+    task_result_callback(failed=outcome != "ok")
+    return lease["task"], "done" if outcome == "ok" else "failed", outcome, http_status
 
-    checkpoint[parquet_file]["progress"] = index_in_file
-    possibly_save_checkpoint(checkpoint, args.checkpoint_file)
 
-    return JSONResponse(content=task)
+@app.get("/task")
+async def get_task(request: Request, n: int = None):
+    """Handle task request from worker.
+
+    Without `n` a single task object is returned. With `n` up to n tasks are leased
+    in one round trip and returned as {"tasks": [...]}, which is empty when nothing
+    can be handed out right now.
+    """
+    worker = request.headers.get("X-Worker-Id")
+    metrics.worker_last_seen.labels(worker=worker or "unknown").set_to_current_time()
+    if n is not None:
+        tasks = lease_tasks(max(1, min(n, args.max_lease_size)), worker)
+        if not tasks:
+            stop_if_finished()
+        return JSONResponse(content={"tasks": tasks})
+
+    tasks = lease_tasks(1, worker)
+    if not tasks:
+        # Nothing to hand out right now, or nothing left at all
+        stop_if_finished()
+        return Response(status_code=204)
+
+    return JSONResponse(content=tasks[0])
 
 
 @app.post("/done")
 async def acknowledge_task(request: Request):
-    """Acknowledge that a worker has completed a task."""
+    """Acknowledge that a worker has completed a task.
+
+    Accepts either a single ack {"id": ..., "file": ..., "row": ...} or a batch
+    {"acks": [{"id": ..., "file": ..., "row": ...}, ...]}. Acks may carry the `outcome` class of the crawl ("ok" if missing), the
+    `http_status` of the page and per-stage `timings`.
+    """
     # get json data in sync
     ack_data = await request.json()
-    task_id = ack_data["id"]
-    logging.info(f"Received acknowledgment for task {task_id}")
+    acks = ack_data["acks"] if "acks" in ack_data else [ack_data]
+    process_acks(acks, request.headers.get("X-Worker-Id"))
+
+    return Response(status_code=200)
+
+
+def process_acks(acks, worker=None):
+    metrics.worker_last_seen.labels(worker=worker or "unknown").set_to_current_time()
+    registry.record_ack(worker, len(acks))
+    results = []
+    for ack in acks:
+        logging.info(f"Received acknowledgment for task {ack['id']}")
+        result = complete_task(ack, worker)
+        if result is not None:
+            results.append(result)
+    ledger.record_results(results)
+    if results:
+        notify_work()
+        stop_if_finished()
+
+
+@app.websocket("/ws")
+async def push_tasks(websocket: WebSocket):
+    """Push tasks to a worker as soon as they can be handed out.
+
+    The worker sends {"type": "credit", "n": k} to announce k more free slots; its
+    acks go to POST /done. The publisher sends {"type": "tasks", "tasks": [...]}
+    whenever it has tasks and the worker has credit left. Credit does not survive a
+    reconnect; the worker re-announces it.
+    """
+    await websocket.accept()
+    worker = websocket.headers.get("X-Worker-Id")
+    credit = 0
+    credit_changed = asyncio.Event()
+
+    async def receive():
+        nonlocal credit
+        while True:
+            message = await websocket.receive_json()
+            if message["type"] == "credit":
+                credit += message["n"]
+                credit_changed.set()
+
+    async def send():
+        nonlocal credit
+        while True:
+            if credit <= 0:
+                await credit_changed.wait()
+                credit_changed.clear()
+                continue
+            waiter = work_available
+            tasks = lease_tasks(min(credit, args.max_lease_size), worker)
+            if tasks:
+                credit -= len(tasks)
+                await websocket.send_json({"type": "tasks", "tasks": tasks})
+                continue
+            if stop_if_finished():
+                return
+            # Host spacing and retry backoff are time based, so also wake up when they end
+            try:
+                await asyncio.wait_for(waiter.wait(), timeout=next_work_delay())
+            except asyncio.TimeoutError:
+                pass
+
+    receiver = asyncio.create_task(receive())
+    sender = asyncio.create_task(send())
+    try:
+        done, _ = await asyncio.wait([receiver, sender], return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    except WebSocketDisconnect:
+        logging.info(f"Worker {worker} disconnected")
+    finally:
+        receiver.cancel()
+        sender.cancel()
+
+
+@app.post("/register")
+async def register_worker(request: Request):
+    """Register a worker with its initial status, see /heartbeat."""
+    status = await request.json()
+    worker = request.headers.get("X-Worker-Id") or status["worker_id"]
+    print(f"Worker {worker} registered with {status.get('max_pages')} pages.")
+    update_worker_status(worker, status)
+    return Response(status_code=200)
 
-    # Clean up queue
-    if task_id in tasks_in_progress:
-        del tasks_in_progress[task_id]
-    else:
-        logging.warning(f"Received acknowledgment for unknown task {task_id}. Maybe it timed out.")
-    
-    task_result_callback()
 
+@app.post("/heartbeat")
+async def worker_heartbeat(request: Request):
+    """Record a worker's status.
+
+    The status has the worker's `free_slots`, `pages_open`, `max_pages`, the `rss_bytes`
+    of its browser process trees, its recent `pages_per_minute`, the `draining_slots` of
+    browsers draining for a restart, the memory of each of its `browsers` and the requests its
+    browsers blocked (`interception`).
+    """
+    status = await request.json()
+    worker = request.headers.get("X-Worker-Id") or status["worker_id"]
+    update_worker_status(worker, status)
     return Response(status_code=200)
 
 
+def update_worker_status(worker, status):
+    info = registry.heartbeat(worker, status)
+    metrics.worker_last_seen.labels(worker=worker).set_to_current_time()
+    metrics.worker_free_slots.labels(worker=worker).set(info["free_slots"])
+    metrics.worker_open_pages.labels(worker=worker).set(info["pages_open"])
+    metrics.worker_rss_bytes.labels(worker=worker).set(info["rss_bytes"])
+    metrics.worker_max_browser_rss_bytes.labels(worker=worker).set(info["max_browser_rss_bytes"])
+    metrics.worker_memory_recycles.labels(worker=worker).set(info["memory_recycles"])
+    metrics.worker_blocked_requests.labels(worker=worker).set(info["interception"].get("blocked_requests", 0))
+    metrics.worker_blocked_bytes.labels(worker=worker).set(info["interception"].get("blocked_bytes", 0))
+    metrics.worker_pages_per_minute.labels(worker=worker).set(info["pages_per_minute"])
+    metrics.worker_draining_slots.labels(worker=worker).set(info["draining_slots"])
+    if info["free_slots"] > 0:
+        notify_work()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Expose publisher metrics in Prometheus text format."""
+    content, content_type = metrics.render()
+    return Response(content=content, media_type=content_type)
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Publish tasks from Parquet files.")
     parser.add_argument("--parquet_folder", type=str,
@@ -150,27 +545,101 @@ def parse_args():
     parser.add_argument("--checkpoint_file", type=str, default="checkpoint.json",
                         help="Path to the JSON file for saving checkpoints.")
     parser.add_argument("--max_queue_size", type=int, default=2,
-                        help="Maximum number of jobs allowed in the queue.")
+                        help="Maximum number of jobs a worker may hold beyond its free slots.")
+    parser.add_argument("--heartbeat_timeout", type=float, default=60,
+                        help="Seconds without a heartbeat after which a worker is forgotten.")
     parser.add_argument("--url", type=str, default="localhost",
                         help="Publish address.")
     parser.add_argument("--port", type=int, default=10086,
                         help="Publish port.")
     parser.add_argument("--batch_size", type=int, default=100,
-                        help="Number of URLs to publish before saving progress.")
-    parser.add_argument("--worker_timeout", type=int, default=300)
-    parser.add_argument("--save_interval", type=int, default=100)
+                        help="Number of finished URLs after which progress is saved, even before --save_interval.")
+    parser.add_argument("--worker_timeout", type=int, default=300,
+                        help="Seconds a worker may hold a task before it is re-dispatched.")
+    parser.add_argument("--max_attempts", type=int, default=3,
+                        help="Maximum number of times a task is handed out before giving up on it.")
+    parser.add_argument("--reap_interval", type=float, default=5,
+                        help="Seconds between scans for expired leases.")
+    parser.add_argument("--save_interval", type=int, default=100,
+                        help="Seconds between checkpoint writes when progress changed.")
+    parser.add_argument("--ledger_file", type=str, default="ledger.sqlite",
+                        help="Path to the SQLite database recording the state of every task.")
+    parser.add_argument("--max_per_host", type=int, default=2,
+                        help="Maximum number of tasks of the same host in flight at once.")
+    parser.add_argument("--host_interval", type=float, default=1.0,
+                        help="Minimum number of seconds between two tasks handed out for the same host.")
+    parser.add_argument("--scheduler_lookahead", type=int, default=10000,
+                        help="Number of rows buffered ahead of the workers to interleave hosts.")
+    parser.add_argument("--max_hosts", type=int, default=100000,
+                        help="Maximum number of recently dispatched hosts to remember.")
+    parser.add_argument("--verify_checksum", action="store_true",
+                        help="Also verify files against a full MD5 of their content. Slow, reads every file.")
+    parser.add_argument("--push_poll_interval", type=float, default=0.5,
+                        help="Seconds a push channel with credit waits before checking for throttled or delayed tasks again.")
+    parser.add_argument("--dedup_file", type=str, default="seen_urls.bloom",
+                        help="Path to the Bloom filter of URLs crawled in this and earlier runs.")
+    parser.add_argument("--dedup_capacity", type=int, default=50_000_000,
+                        help="Number of URLs the dedup filters are sized for.")
+    parser.add_argument("--dedup_error_rate", type=float, default=0.01,
+                        help="False positive rate of the dedup filters at capacity.")
+    parser.add_argument("--dedup_save_interval", type=float, default=600,
+                        help="Seconds between writes of the dedup filter.")
+    parser.add_argument("--max_lease_size", type=int, default=256,
+                        help="Maximum number of tasks handed out by a single /task?n= request.")
 
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_args()
 
-    # Global variable to store the length of the queue
-    tasks_in_progress = {}
-    
-    # Load resume state from checkpoint
-    data_loader, checkpoint, num_tasks = load_from_checkpoint(args.parquet_folder, args.checkpoint_file)
+    # In-flight tasks, re-dispatched when a worker does not ack them in time
+    lease_manager = LeaseManager(timeout=args.worker_timeout, max_attempts=args.max_attempts)
+
+    # Workers with the capacity and health they report
+    registry = WorkerRegistry(max_queue_size=args.max_queue_size, stale_after=args.heartbeat_timeout)
+
+    # Durable per-task state
+    ledger = TaskLedger(args.ledger_file)
+
+    # Load resume state from checkpoint and ledger
+    data_loader, checkpoint, num_tasks = load_from_checkpoint(
+        args.parquet_folder, args.checkpoint_file, args.verify_checksum, ledger
+    )
+    restore_from_ledger()
+
+    # Checkpoint persistence runs in the background, see lifespan()
+    checkpoint_writer = CheckpointWriter(
+        checkpoint,
+        args.checkpoint_file,
+        interval=args.save_interval,
+        max_changes=args.batch_size,
+        on_saved=lambda saved_at: ledger.set_meta("checkpoint_at", saved_at),
+        on_write_time=metrics.checkpoint_write_seconds.observe,
+    )
+
+    metrics.tasks_in_flight.set_function(lambda: len(lease_manager))
+    metrics.tasks_queued_for_retry.set_function(lambda: len(lease_manager.queued))
+
+    # URLs crawled in earlier runs, and URLs published in this run
+    if os.path.exists(args.dedup_file):
+        seen_urls = BloomFilter.load(args.dedup_file)
+        print(f"Loaded {seen_urls.count} crawled URLs from {args.dedup_file}")
+    else:
+        seen_urls = BloomFilter(args.dedup_capacity, args.dedup_error_rate)
+    run_urls = BloomFilter(args.dedup_capacity, args.dedup_error_rate)
+    metrics.dedup_filter_fill.labels(filter="seen").set_function(lambda: seen_urls.count / seen_urls.capacity)
+    metrics.dedup_filter_fill.labels(filter="run").set_function(lambda: run_urls.count / run_urls.capacity)
+
+    scheduler = HostScheduler(
+        dedup_tasks(data_loader),
+        max_per_host=args.max_per_host,
+        min_interval=args.host_interval,
+        lookahead=args.scheduler_lookahead,
+        max_hosts=args.max_hosts,
+    )
 
     pbar = tqdm(total=num_tasks, desc="Publishing tasks")
 
-    uvicorn.run(app, host=args.url, port=args.port, log_level="critical")
+    # Stopped through `should_exit` once all tasks are done, see stop_if_finished()
+    server = uvicorn.Server(uvicorn.Config(app, host=args.url, port=args.port, log_level="critical"))
+    server.run()
@@ -0,0 +1,170 @@
+import heapq
+import time
+from collections import deque
+
+
+# Retry policy per failure class reported in acks: seconds before the first retry,
+# doubled on every further attempt, and the maximum number of attempts.
+RETRY_POLICIES = {
+    "timeout": {"backoff": 60, "max_attempts": 3},
+    "navigation_error": {"backoff": 120, "max_attempts": 2},
+    "storage_error": {"backoff": 5, "max_attempts": 5},
+    "http_error": {"backoff": 300, "max_attempts": 3},
+    "deadline_exceeded": {"backoff": 600, "max_attempts": 2},
+}
+
+# HTTP statuses worth retrying; any other failed status is treated as permanent
+RETRYABLE_HTTP_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+def retry_delay(outcome, http_status, attempt):
+    """Seconds to wait before retrying a failed task, or None if it should not be retried."""
+    policy = RETRY_POLICIES.get(outcome)
+    if policy is None or attempt >= policy["max_attempts"]:
+        return None
+    if outcome == "http_error" and http_status is not None and http_status not in RETRYABLE_HTTP_STATUSES:
+        return None
+    return policy["backoff"] * 2 ** (attempt - 1)
+
+
+def task_key(task):
+    """Key of a task, or of its ack: the parquet file and row it comes from.
+
+    Task ids are only unique within a file, e.g. when they are the RangeIndex of the
+    file, so they cannot identify a task on their own.
+    """
+    return task["file"], task["row"]
+
+
+class LeaseManager:
+    """Tracks in-flight tasks by deadline and re-dispatches the ones whose lease expired.
+
+    Leases are kept in a dict keyed by `task_key`, with a min-heap of (deadline, key)
+    next to it. Acked leases are not removed from the heap; stale heap entries are
+    skipped when they reach the top. Expired tasks go to a retry queue which is served
+    ahead of fresh rows, until a task has been handed out `max_attempts` times.
+    Tasks that failed on the worker side wait in a heap of (ready_at, key) until
+    their backoff has passed, then join the retry queue.
+    """
+
+    def __init__(self, timeout=300, max_attempts=3):
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.leases = {}  # key -> lease record
+        self.deadlines = []  # heap of (deadline, key)
+        self.retry_queue = deque()
+        self.queued = {}  # key -> task, for tasks in the retry queue that have not been acked since
+        self.attempts = {}  # key -> number of times the task has been handed out
+        self.delayed = []  # heap of (ready_at, key) for failed tasks waiting for their backoff
+
+    def __len__(self):
+        return len(self.leases)
+
+    def __contains__(self, key):
+        return key in self.leases or key in self.queued
+
+    def find(self, task_id):
+        """Key of the only leased or queued task with id `task_id`, for acks that only carry the id."""
+        keys = [key for key, lease in self.leases.items() if lease["task"]["id"] == task_id]
+        keys += [key for key, task in self.queued.items() if task["id"] == task_id]
+        return keys[0] if len(keys) == 1 else None
+
+    def lease(self, task, now=None):
+        """Record that `task` was handed out. Returns the lease record."""
+        now = time.time() if now is None else now
+        key = task_key(task)
+        attempt = self.attempts.get(key, 0) + 1
+        self.attempts[key] = attempt
+        lease = {
+            "task": task,
+            "timestamp": now,
+            "deadline": now + self.timeout,
+            "attempt": attempt,
+        }
+        self.leases[key] = lease
+        heapq.heappush(self.deadlines, (lease["deadline"], key))
+        return lease
+
+    def ack(self, key):
+        """Release the lease of a finished task. Returns the lease record, or None if unknown."""
+        lease = self.leases.pop(key, None)
+        if lease is None and key in self.queued:
+            # Late ack of a task that already expired and is waiting to be re-dispatched
+            lease = {"task": self.queued.pop(key), "attempt": self.attempts.get(key, 0)}
+        elif lease is None:
+            return None
+        self.attempts.pop(key, None)
+        return lease
+
+    def retry_later(self, key, delay, now=None):
+        """Release the lease of a failed task and hand it out again after `delay` seconds."""
+        now = time.time() if now is None else now
+        lease = self.leases.pop(key, None)
+        if lease is None:
+            return None
+        self.queued[key] = lease["task"]
+        heapq.heappush(self.delayed, (now + delay, key))
+        return lease
+
+    def restore(self, task, attempts):
+        """Queue a task that was in flight when the publisher last stopped."""
+        self.attempts[task_key(task)] = attempts
+        self.retry_queue.append(task)
+        self.queued[task_key(task)] = task
+
+    def next_retry(self, now=None):
+        """Pop the next expired or failed task that should be handed out again, if any."""
+        now = time.time() if now is None else now
+        while self.delayed and self.delayed[0][0] <= now:
+            _, key = heapq.heappop(self.delayed)
+            if key in self.queued:
+                self.retry_queue.append(self.queued[key])
+        while self.retry_queue:
+            task = self.retry_queue.popleft()
+            if self.queued.pop(task_key(task), None) is not None:
+                return task
+        return None
+
+    def defer(self, task, ready_at):
+        """Put back a task from `next_retry`, to be handed out again from `ready_at` on."""
+        key = task_key(task)
+        self.queued[key] = task
+        heapq.heappush(self.delayed, (ready_at, key))
+
+    def hold(self, tasks):
+        """Put back tasks from `next_retry` at the front of the retry queue, in their order."""
+        for task in reversed(tasks):
+            self.queued[task_key(task)] = task
+            self.retry_queue.appendleft(task)
+
+    def next_ready_at(self):
+        """Time at which the next failed task's backoff ends, or None if none is waiting."""
+        return self.delayed[0][0] if self.delayed else None
+
+    def has_retries(self):
+        return bool(self.queued)
+
+    def reap(self, now=None):
+        """Expire overdue leases.
+
+        Tasks with attempts left are put on the retry queue. Returns (expired, abandoned):
+        every task whose lease expired, and the subset that was given up on because it
+        hit `max_attempts`.
+        """
+        now = time.time() if now is None else now
+        expired = []
+        abandoned = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(self.deadlines)
+            lease = self.leases.get(key)
+            if lease is None or lease["deadline"] != deadline:
+                continue  # Acked or re-leased since this entry was pushed
+            del self.leases[key]
+            expired.append(lease["task"])
+            if lease["attempt"] >= self.max_attempts:
+                self.attempts.pop(key, None)
+                abandoned.append(lease["task"])
+            else:
+                self.retry_queue.append(lease["task"])
+                self.queued[key] = lease["task"]
+        return expired, abandoned
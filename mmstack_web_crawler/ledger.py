@@ -0,0 +1,135 @@
+import time
+import sqlite3
+
+from mmstack_web_crawler.scheduler import host_of
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id,
+    file TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    host TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    leased_at REAL,
+    deadline REAL,
+    finished_at REAL,
+    worker TEXT,
+    outcome TEXT,
+    http_status INTEGER,
+    PRIMARY KEY (file, row)
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks(state);
+CREATE INDEX IF NOT EXISTS tasks_finished_at ON tasks(finished_at);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class TaskLedger:
+    """Durable record of every task the publisher handed out, in an SQLite database in WAL mode.
+
+    Tasks are keyed by their parquet file and row, since task ids repeat across
+    files. Each task row moves through the states pending -> leased -> done / failed, with
+    its attempt count, lease and finish times, the worker holding it and the outcome
+    class and HTTP status of its last acknowledgement. Every lease
+    or ack batch is written in a single transaction. After a crash the publisher
+    re-queues the unfinished tasks from the ledger instead of waiting for them to be
+    re-issued from the parquet files.
+
+    The database can be queried offline while the publisher runs, e.g.
+        SELECT host, outcome, COUNT(*) FROM tasks WHERE state = 'failed' GROUP BY 1, 2 ORDER BY 3 DESC;
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _transaction(self, sql, rows):
+        if not rows:
+            return
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(sql, rows)
+
+    def record_leases(self, leases, worker=None):
+        """Record a batch of lease records from `LeaseManager.lease`."""
+        self._transaction(
+            """
+            INSERT INTO tasks (id, file, row, url, host, state, attempts, leased_at, deadline, worker)
+            VALUES (?, ?, ?, ?, ?, 'leased', ?, ?, ?, ?)
+            ON CONFLICT(file, row) DO UPDATE SET
+                id = excluded.id,
+                url = excluded.url,
+                host = excluded.host,
+                state = 'leased',
+                attempts = excluded.attempts,
+                leased_at = excluded.leased_at,
+                deadline = excluded.deadline,
+                worker = excluded.worker
+            """,
+            [
+                (
+                    lease["task"]["id"],
+                    lease["task"]["file"],
+                    lease["task"]["row"],
+                    lease["task"]["url"],
+                    host_of(lease["task"]["url"]),
+                    lease["attempt"],
+                    lease["timestamp"],
+                    lease["deadline"],
+                    worker,
+                )
+                for lease in leases
+            ],
+        )
+
+    def record_states(self, tasks, state, now=None):
+        """Move a batch of tasks to `state` ("pending", "done" or "failed")."""
+        now = time.time() if now is None else now
+        finished_at = now if state in ("done", "failed") else None
+        self._transaction(
+            "UPDATE tasks SET state = ?, finished_at = ? WHERE file = ? AND row = ?",
+            [(state, finished_at, task["file"], task["row"]) for task in tasks],
+        )
+
+    def record_results(self, results, now=None):
+        """Record a batch of acknowledged tasks as (task, state, outcome, http_status) tuples."""
+        now = time.time() if now is None else now
+        self._transaction(
+            "UPDATE tasks SET state = ?, finished_at = ?, outcome = ?, http_status = ? WHERE file = ? AND row = ?",
+            [
+                (state, now if state in ("done", "failed") else None, outcome, http_status, task["file"], task["row"])
+                for task, state, outcome, http_status in results
+            ],
+        )
+
+    def unfinished(self):
+        """Tasks that were pending or leased when the publisher stopped, with their attempt counts."""
+        rows = self.conn.execute(
+            "SELECT id, url, file, row, attempts FROM tasks WHERE state IN ('pending', 'leased') ORDER BY leased_at"
+        )
+        return [({"id": task_id, "url": url, "file": file, "row": row}, attempts) for task_id, url, file, row, attempts in rows]
+
+    def finished_since(self, since):
+        """(file, row) of tasks that were done or failed at or after `since`."""
+        return self.conn.execute(
+            "SELECT file, row FROM tasks WHERE state IN ('done', 'failed') AND finished_at >= ?", (since,)
+        ).fetchall()
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
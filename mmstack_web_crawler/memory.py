@@ -0,0 +1,95 @@
+import time
+import asyncio
+import psutil
+
+
+def process_tree_rss(pid):
+    """RSS in bytes of a process and all of its descendants, 0 if it is gone."""
+    try:
+        root = psutil.Process(pid)
+        processes = [root] + root.children(recursive=True)
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return 0
+    rss = 0
+    for process in processes:
+        try:
+            rss += process.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+    return rss
+
+
+def rss_slope(samples):
+    """Least squares slope, in bytes per minute, of (timestamp, rss) samples."""
+    if len(samples) < 2:
+        return 0.0
+    mean_t = sum(t for t, _ in samples) / len(samples)
+    mean_rss = sum(rss for _, rss in samples) / len(samples)
+    var_t = sum((t - mean_t) ** 2 for t, _ in samples)
+    if var_t == 0:
+        return 0.0
+    cov = sum((t - mean_t) * (rss - mean_rss) for t, rss in samples)
+    return cov / var_t * 60
+
+
+class MemoryGovernor:
+    """Recycles browsers of a `BrowserPool` based on the memory they actually use.
+
+    Every `interval` seconds the RSS of each browser's own process tree (its
+    Playwright driver and the Chromium processes below it) is sampled. A browser
+    is drained and relaunched once its RSS exceeds `max_rss` bytes, or once it has
+    kept growing by more than `max_slope` bytes per minute over the last `window`
+    seconds. Other browsers, and the pages they serve, are left alone.
+    """
+
+    def __init__(self, pool, max_rss=None, max_slope=None, interval=10, window=300, min_samples=6, logger=None):
+        self.pool = pool
+        self.max_rss = max_rss
+        self.max_slope = max_slope
+        self.interval = interval
+        self.window = window
+        self.min_samples = min_samples
+        self.logger = logger
+        self.recycles = 0  # browsers recycled because of their memory
+
+    def _log(self, message):
+        if self.logger:
+            self.logger.warning(message)
+        else:
+            print(message)
+
+    def check(self, browser):
+        """Reason to recycle a browser given its latest samples, or None."""
+        if self.max_rss and browser.rss > self.max_rss:
+            return f"RSS {browser.rss / 2 ** 20:.0f} MB above {self.max_rss / 2 ** 20:.0f} MB"
+        if (
+            self.max_slope
+            and len(browser.rss_samples) >= self.min_samples
+            and browser.rss_samples[-1][0] - browser.rss_samples[0][0] >= self.window / 2
+            and browser.rss_slope > self.max_slope
+        ):
+            return f"RSS growing {browser.rss_slope / 2 ** 20:.1f} MB/min"
+        return None
+
+    async def sample(self, now=None):
+        now = time.time() if now is None else now
+        for browser in list(self.pool.browsers):
+            if browser.draining or browser.closed:
+                continue
+            pid = browser.crawler.browser_handler.driver_pid()
+            if pid is None:
+                continue
+            rss = await asyncio.to_thread(process_tree_rss, pid)
+            browser.record_rss(now, rss, self.window)
+            if browser.recycle_reason:
+                continue
+            reason = self.check(browser)
+            if reason:
+                self._log(f"Recycling browser {browser.index}: {reason}")
+                self.recycles += 1
+                self.pool.request_recycle(browser, reason)
+
+    async def run(self):
+        while True:
+            await self.sample()
+            await asyncio.sleep(self.interval)
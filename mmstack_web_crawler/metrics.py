@@ -0,0 +1,117 @@
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import disable_created_metrics
+
+# Don't export a *_created series next to every counter and histogram
+disable_created_metrics()
+
+# Metrics of the job publisher, exposed in Prometheus text format on /metrics
+registry = CollectorRegistry()
+
+AGE_BUCKETS = (1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300, 600)
+STAGE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60, 120)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+tasks_leased = Counter(
+    "publisher_tasks_leased_total", "Tasks handed out to workers.", ["worker"], registry=registry
+)
+tasks_acked = Counter(
+    "publisher_tasks_acked_total", "Tasks acknowledged by workers.", ["worker"], registry=registry
+)
+task_outcomes = Counter(
+    "publisher_task_outcomes_total", "Acknowledgements by outcome class.", ["outcome"], registry=registry
+)
+tasks_retried = Counter(
+    "publisher_tasks_retried_total", "Failed tasks scheduled for another attempt, by outcome class.", ["outcome"],
+    registry=registry
+)
+tasks_expired = Counter(
+    "publisher_tasks_expired_total", "Leases that expired before the task was acknowledged.", registry=registry
+)
+tasks_abandoned = Counter(
+    "publisher_tasks_abandoned_total", "Tasks given up on after reaching the attempt limit.", registry=registry
+)
+unknown_acks = Counter(
+    "publisher_unknown_acks_total", "Acknowledgements for tasks that were not in flight.", registry=registry
+)
+duplicate_urls = Counter(
+    "publisher_duplicate_urls_total", "Rows skipped because their URL was already crawled or published.",
+    registry=registry
+)
+dedup_filter_fill = Gauge(
+    "publisher_dedup_filter_fill", "URLs in each dedup filter relative to the capacity it was sized for.", ["filter"],
+    registry=registry
+)
+tasks_in_flight = Gauge(
+    "publisher_tasks_in_flight", "Tasks currently leased to workers.", registry=registry
+)
+tasks_queued_for_retry = Gauge(
+    "publisher_tasks_queued_for_retry", "Expired tasks waiting to be handed out again.", registry=registry
+)
+worker_last_seen = Gauge(
+    "publisher_worker_last_seen_timestamp_seconds", "Time of the last request of each worker.", ["worker"], registry=registry
+)
+worker_free_slots = Gauge(
+    "publisher_worker_free_slots", "Free page slots reported by each worker.", ["worker"], registry=registry
+)
+worker_open_pages = Gauge(
+    "publisher_worker_open_pages", "Browser pages open on each worker.", ["worker"], registry=registry
+)
+worker_rss_bytes = Gauge(
+    "publisher_worker_rss_bytes", "RSS of each worker's browser process tree.", ["worker"], registry=registry
+)
+worker_max_browser_rss_bytes = Gauge(
+    "publisher_worker_max_browser_rss_bytes", "RSS of the largest browser process tree of each worker.", ["worker"],
+    registry=registry
+)
+worker_memory_recycles = Gauge(
+    "publisher_worker_memory_recycles", "Browsers each worker recycled because of their memory.", ["worker"],
+    registry=registry
+)
+worker_blocked_requests = Gauge(
+    "publisher_worker_blocked_requests", "Requests each worker's browsers aborted during capture.", ["worker"],
+    registry=registry
+)
+worker_blocked_bytes = Gauge(
+    "publisher_worker_blocked_bytes", "Announced size of the oversized responses each worker aborted.", ["worker"],
+    registry=registry
+)
+worker_pages_per_minute = Gauge(
+    "publisher_worker_pages_per_minute", "Recent throughput reported by each worker.", ["worker"], registry=registry
+)
+worker_draining_slots = Gauge(
+    "publisher_worker_draining_slots", "Page slots of each worker's browsers that are draining for a restart.",
+    ["worker"], registry=registry
+)
+lease_age = Histogram(
+    "publisher_lease_age_seconds", "Time between handing out a task and its acknowledgement.",
+    buckets=AGE_BUCKETS, registry=registry
+)
+lease_batch_size = Histogram(
+    "publisher_lease_batch_size", "Number of tasks handed out per /task request.",
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128, 256), registry=registry
+)
+worker_stage_seconds = Histogram(
+    "publisher_worker_stage_seconds", "Stage timings reported by workers with their acknowledgements.", ["stage"],
+    buckets=STAGE_BUCKETS, registry=registry
+)
+checkpoint_write_seconds = Histogram(
+    "publisher_checkpoint_write_seconds", "Time spent writing the checkpoint file.",
+    buckets=LATENCY_BUCKETS, registry=registry
+)
+
+
+def remove_worker(worker):
+    """Drop the per-worker series of a worker that went away."""
+    for gauge in (
+        worker_last_seen, worker_free_slots, worker_open_pages, worker_rss_bytes, worker_max_browser_rss_bytes,
+        worker_memory_recycles, worker_blocked_requests, worker_blocked_bytes, worker_pages_per_minute, worker_draining_slots,
+    ):
+        try:
+            gauge.remove(worker)
+        except KeyError:
+            pass
+
+
+def render():
+    """Return the metrics in Prometheus text format, with its content type."""
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -4,15 +4,33 @@ import asyncio
 import aiofiles
 import asyncio
 
+from io import BytesIO
 from pathlib import Path
 
 from PIL import Image, ImageDraw
 import pillow_avif
 
+from mmstack_web_crawler.timing import StageTimer
+from mmstack_web_crawler.element_table import write_element_table
+
 async def save_image_async(image: Image.Image, image_path: str, format: str = "AVIF"):
     loop = asyncio.get_event_loop()
     await loop.run_in_executor(None, image.save, image_path, format)
 
+def encode_image(image: Image.Image, format: str = "PNG") -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format)
+    return buffer.getvalue()
+
+async def save_image_timed(image: Image.Image, image_path, format: str, timer: StageTimer):
+    """Like `save_image_async`, timing the encoding and the disk write as separate stages."""
+    loop = asyncio.get_event_loop()
+    with timer.span("image_encode"):
+        encoded = await loop.run_in_executor(None, encode_image, image, format)
+    with timer.span("image_write"):
+        async with aiofiles.open(image_path, "wb") as image_file:
+            await image_file.write(encoded)
+
         
 class FileStorage:
     def __init__(self, base_path: str):
@@ -20,7 +38,13 @@ class FileStorage:
         self.base_path.mkdir(parents=True, exist_ok=True)
         self.jsonl_file = self.base_path / "data.jsonl"
 
-    async def save(self, data: dict):
+    async def save(self, data: dict, timer: StageTimer = None):
+        """Save a crawled page under <base_path>/<id>/.
+
+        With a `timer`, the time of each step is recorded in it. The per-stage timings
+        of the whole page are written separately, by `save_timings`, once they are final.
+        """
+        timer = StageTimer(stats=None) if timer is None else timer
         # Validate input data
         required_keys = {"image", "html"}
         if not all(key in data["content"] for key in required_keys):
@@ -33,20 +57,36 @@ class FileStorage:
 
         # Save the image file
         image_path = task_dir / f"{task_id}.png"
-        await save_image_async(data["content"]["image"], image_path, "PNG")
+        await save_image_timed(data["content"]["image"], image_path, "PNG", timer)
         
         if "annotated_image" in data["content"]:
             annotated_image_path = task_dir / f"{task_id}_annotated.png"
-            await save_image_async(data["content"]["annotated_image"], annotated_image_path, "PNG")
+            await save_image_timed(data["content"]["annotated_image"], annotated_image_path, "PNG", timer)
 
         # Save the html file
         html_path = task_dir / f"{task_id}.html"
-        async with aiofiles.open(html_path, 'w') as html_file:
-            await html_file.write(data["content"]["html"])
+        with timer.span("html_write"):
+            async with aiofiles.open(html_path, 'w') as html_file:
+                await html_file.write(data["content"]["html"])
+
+        # Save the element table next to the screenshot
+        if "elements" in data["content"]:
+            elements_path = task_dir / f"{task_id}_elements.parquet"
+            with timer.span("elements_write"):
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, write_element_table, data["content"]["elements"], elements_path)
 
         # Append to the jsonl file
         jsonl_data = {"id": task_id, "url": data["url"]}
-        with open(self.jsonl_file, "a") as jsonl:
-            jsonl.write(json.dumps(jsonl_data) + "\n")
+        with timer.span("jsonl_write"):
+            with open(self.jsonl_file, "a") as jsonl:
+                jsonl.write(json.dumps(jsonl_data) + "\n")
+
+    async def save_timings(self, data: dict, timings: dict):
+        """Write the per-stage timings of a saved page to <id>_timings.json next to its data."""
+        task_id = data["id"]
+        timings_path = self.base_path / str(task_id) / f"{task_id}_timings.json"
+        async with aiofiles.open(timings_path, 'w') as timings_file:
+            await timings_file.write(json.dumps({"id": task_id, "url": data["url"], "timings": timings}))
 
         print(f"Saved data for id: {task_id}")
\ No newline at end of file
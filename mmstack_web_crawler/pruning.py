@@ -0,0 +1,116 @@
+import copy
+
+import numpy as np
+import lxml.html
+from lxml import etree
+from lxml.etree import ParserError
+
+
+def parse_bboxes(values):
+    """(N, 4) int64 array of `__bbox__` strings "(left,top,right,bottom)", with a row of -1 where unparsable."""
+    boxes = np.full((len(values), 4), -1, dtype=np.int64)
+    if not values:
+        return boxes
+    try:
+        flat = np.array(",".join(value.strip("() ") for value in values).split(","), dtype=np.int64)
+        return flat.reshape(len(values), 4)
+    except ValueError:
+        # Some value is malformed: fall back to one at a time
+        for i, value in enumerate(values):
+            try:
+                parts = [int(part) for part in value.strip("() ").split(",")]
+            except ValueError:
+                continue
+            if len(parts) == 4:
+                boxes[i] = parts
+        return boxes
+
+
+def parse_html(html_content):
+    """Root element of an HTML document, or None if it has no content to parse."""
+    try:
+        return lxml.html.document_fromstring(html_content)
+    except ValueError:
+        # lxml refuses str input with an XML encoding declaration; the text is already decoded
+        try:
+            return lxml.html.document_fromstring(
+                html_content.encode("utf-8"), parser=lxml.html.HTMLParser(encoding="utf-8")
+            )
+        except ParserError:
+            return None
+    except ParserError:
+        return None
+
+
+class VisibilityPruner:
+    """Removes the elements of an HTML document that lie outside a viewport.
+
+    The document is parsed once with lxml, and the `__bbox__` of all its elements is
+    read into a NumPy array. For each viewport, the elements whose box does not
+    intersect it are found in one vectorized pass, and only the top-most of them
+    are dropped, from the last one to the first, on a copy of the tree. Elements
+    without a box, or with an empty box, are kept. A document lxml cannot parse,
+    e.g. an empty one, is returned unchanged.
+    """
+
+    def __init__(self, html_content):
+        self.html_content = html_content
+        self.root = parse_html(html_content)
+        if self.root is None:
+            return
+        # lxml reports a default doctype for documents without one, so only keep a declared one
+        declared = html_content.lstrip()[:9].lower() == "<!doctype"
+        self.doctype = self.root.getroottree().docinfo.doctype if declared else None
+        self.elements = list(self.root.iter(etree.Element))
+
+        index = {element: i for i, element in enumerate(self.elements)}
+        self.parents = np.array(
+            [index.get(element.getparent(), -1) for element in self.elements], dtype=np.int64
+        )
+        # Depth of every element, to resolve ancestors level by level
+        self.depths = np.zeros(len(self.elements), dtype=np.int64)
+        for i, parent in enumerate(self.parents):
+            if parent >= 0:
+                self.depths[i] = self.depths[parent] + 1
+
+        boxed = [i for i, element in enumerate(self.elements) if "__bbox__" in element.attrib]
+        self.boxes = np.full((len(self.elements), 4), -1, dtype=np.int64)
+        self.boxes[boxed] = parse_bboxes([self.elements[i].attrib["__bbox__"] for i in boxed])
+        # Elements without a box, with an unparsable one or with (0,0,0,0) are always kept
+        self.has_box = np.zeros(len(self.elements), dtype=bool)
+        self.has_box[boxed] = True
+        self.has_box &= (self.boxes != -1).any(axis=1) & (self.boxes != 0).any(axis=1)
+
+    def hidden(self, viewport):
+        """Mask of the elements outside `viewport`, given as (left, top, right, bottom) like `__bbox__`."""
+        view_left, view_top, view_right, view_bottom = viewport
+        left, top, right, bottom = self.boxes.T
+        visible = (top < view_bottom) & (bottom > view_top) & (left < view_right) & (right > view_left)
+        return self.has_box & ~visible
+
+    def topmost(self, remove):
+        """Elements to remove that have no removed ancestor."""
+        covered = np.zeros_like(remove)
+        for depth in range(1, int(self.depths.max(initial=0)) + 1):
+            level = np.flatnonzero(self.depths == depth)
+            parents = self.parents[level]
+            covered[level] = remove[parents] | covered[parents]
+        return remove & ~covered
+
+    def prune(self, viewport):
+        """HTML of the document without the elements outside `viewport`."""
+        if self.root is None:
+            return self.html_content
+        drop = np.flatnonzero(self.topmost(self.hidden(viewport)))
+        root = copy.deepcopy(self.root)
+        elements = list(root.iter(etree.Element)) if len(drop) else []
+        # Bottom-up, so that the positions of the remaining drops are not affected
+        for i in drop[::-1]:
+            elements[i].drop_tree()
+        return lxml.html.tostring(root, encoding="unicode", doctype=self.doctype)
+
+
+def prune_html_by_viewports(html_content, viewports):
+    """Prune an HTML document for several viewports, parsing it only once. Returns one HTML per viewport."""
+    pruner = VisibilityPruner(html_content)
+    return [pruner.prune(viewport) for viewport in viewports]
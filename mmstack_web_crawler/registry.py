@@ -0,0 +1,86 @@
+import math
+import time
+from statistics import median
+
+
+class WorkerRegistry:
+    """Workers known to the publisher, with the capacity and health they last reported.
+
+    Workers register once and then send heartbeats with their free slots, the RSS of
+    their browser processes, their recent pages per minute and the slots of their
+    browsers draining for a restart. `grant` sizes each lease from that: a worker gets
+    at most its free slots plus `max_queue_size` queued tasks, scaled by its speed
+    relative to the fleet, and nothing while all of its browsers drain. Every ack
+    received since the last heartbeat frees one more slot, so the budget refills as
+    pages finish instead of once per heartbeat, but never beyond the slots of the
+    browsers that still serve.
+    Workers that never registered, or whose heartbeats stopped, get what they ask for.
+    """
+
+    def __init__(self, max_queue_size=2, stale_after=60, min_weight=0.5, max_weight=2.0):
+        self.max_queue_size = max_queue_size
+        self.stale_after = stale_after
+        self.min_weight = min_weight
+        self.max_weight = max_weight
+        self.workers = {}  # worker_id -> last reported status
+
+    def heartbeat(self, worker_id, status, now=None):
+        now = time.time() if now is None else now
+        info = self.workers.setdefault(worker_id, {"registered_at": now})
+        info.update(
+            free_slots=status.get("free_slots", 0),
+            pages_open=status.get("pages_open", 0),
+            max_pages=status.get("max_pages", info.get("max_pages")),
+            rss_bytes=status.get("rss_bytes", 0),
+            max_browser_rss_bytes=max((browser["rss_bytes"] for browser in status.get("browsers", [])), default=0),
+            memory_recycles=status.get("memory_recycles", 0),
+            interception=status.get("interception", {}),
+            pages_per_minute=status.get("pages_per_minute", 0.0),
+            draining_slots=status.get("draining_slots", 0),
+            last_seen=now,
+            granted=0,  # tasks leased since this heartbeat
+            acked=0,  # acks received since this heartbeat
+        )
+        return info
+
+    def evict_stale(self, now=None):
+        """Forget workers that have not sent a heartbeat for `stale_after` seconds. Returns their ids."""
+        now = time.time() if now is None else now
+        stale = [worker_id for worker_id, info in self.workers.items() if now - info["last_seen"] > self.stale_after]
+        for worker_id in stale:
+            del self.workers[worker_id]
+        return stale
+
+    def weight(self, info):
+        """Relative speed of a worker compared to the median of the fleet."""
+        rates = [other["pages_per_minute"] for other in self.workers.values() if other["pages_per_minute"] > 0]
+        if not rates or info["pages_per_minute"] <= 0:
+            return 1.0
+        return min(self.max_weight, max(self.min_weight, info["pages_per_minute"] / median(rates)))
+
+    def grant(self, worker_id, requested, now=None):
+        """Number of tasks, at most `requested`, to lease to a worker now."""
+        now = time.time() if now is None else now
+        info = self.workers.get(worker_id)
+        if info is None or now - info["last_seen"] > self.stale_after:
+            return requested
+        free_slots = info["free_slots"] + info["acked"]
+        if info["max_pages"]:
+            serving_slots = info["max_pages"] - info["draining_slots"]
+            if serving_slots <= 0:
+                return 0
+            free_slots = min(free_slots, serving_slots)
+        budget = math.ceil((free_slots + self.max_queue_size) * self.weight(info))
+        return max(0, min(requested, budget - info["granted"]))
+
+    def record_lease(self, worker_id, num_tasks):
+        """Account for tasks actually leased to a worker since its last heartbeat."""
+        info = self.workers.get(worker_id)
+        if info is not None:
+            info["granted"] += num_tasks
+
+    def record_ack(self, worker_id, num_acks):
+        """Account for pages a worker finished since its last heartbeat, each freeing a slot."""
+        info = self.workers.get(worker_id)
+        if info is not None:
+            info["acked"] += num_acks
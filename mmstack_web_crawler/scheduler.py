@@ -0,0 +1,127 @@
+import time
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
+
+
+def host_of(url):
+    try:
+        return (urlsplit(url).hostname or "").lower()
+    except ValueError:
+        return ""
+
+
+class HostScheduler:
+    """Hands out tasks round-robin across hosts, with per-host politeness limits.
+
+    Up to `lookahead` tasks are buffered from `source` into per-host queues. A host
+    is eligible when it has fewer than `max_per_host` tasks in flight and its last
+    task was handed out at least `min_interval` seconds ago. Host state is only kept
+    for hosts with queued or in-flight tasks, plus at most `max_hosts` recently
+    dispatched hosts whose spacing has not yet expired.
+    """
+
+    def __init__(self, source, max_per_host=2, min_interval=1.0, lookahead=10000, max_hosts=100000):
+        self.source = iter(source)
+        self.max_per_host = max_per_host
+        self.min_interval = min_interval
+        self.lookahead = lookahead
+        self.max_hosts = max_hosts
+
+        self.queues = {}  # host -> deque of buffered tasks
+        self.ready = deque()  # hosts with buffered tasks, in round-robin order
+        self.in_flight = {}  # host -> number of leased tasks
+        self.last_dispatch = OrderedDict()  # host -> time of the last hand-out, oldest first
+        self.buffered = 0
+        self.source_exhausted = False
+
+    def exhausted(self):
+        """True when the source is drained and no task is left in the buffer."""
+        return self.source_exhausted and self.buffered == 0
+
+    def _fill(self):
+        while not self.source_exhausted and self.buffered < self.lookahead:
+            try:
+                task = next(self.source)
+            except StopIteration:
+                self.source_exhausted = True
+                break
+            host = host_of(task["url"])
+            if host not in self.queues:
+                self.queues[host] = deque()
+                self.ready.append(host)
+            self.queues[host].append(task)
+            self.buffered += 1
+
+    def _evict(self, now):
+        # Forget hosts whose spacing has expired, and the oldest ones beyond max_hosts
+        while self.last_dispatch:
+            host, last = next(iter(self.last_dispatch.items()))
+            if len(self.last_dispatch) <= self.max_hosts and now - last < self.min_interval:
+                break
+            self.last_dispatch.popitem(last=False)
+
+    def _eligible(self, host, now):
+        if self.in_flight.get(host, 0) >= self.max_per_host:
+            return False
+        last = self.last_dispatch.get(host)
+        return last is None or now - last >= self.min_interval
+
+    def next_task(self, now=None):
+        """Pop the next task that may be dispatched now, or None if every buffered host is throttled."""
+        now = time.time() if now is None else now
+        self._fill()
+        self._evict(now)
+        for _ in range(len(self.ready)):
+            host = self.ready.popleft()
+            if not self._eligible(host, now):
+                self.ready.append(host)
+                continue
+            queue = self.queues[host]
+            task = queue.popleft()
+            self.buffered -= 1
+            if queue:
+                self.ready.append(host)
+            else:
+                del self.queues[host]
+            self.on_lease(task, now)
+            return task
+        return None
+
+    def eligible_at(self, task, now=None):
+        """Time from which `task`'s host may be dispatched to, or None while it is at `max_per_host`."""
+        now = time.time() if now is None else now
+        host = host_of(task["url"])
+        if self.in_flight.get(host, 0) >= self.max_per_host:
+            return None
+        last = self.last_dispatch.get(host)
+        return now if last is None else max(now, last + self.min_interval)
+
+    def next_eligible_at(self):
+        """Earliest time at which a buffered host's spacing expires, or None if none is waiting on it.
+
+        Hosts at `max_per_host` only become eligible on a release, which callers are
+        notified of separately.
+        """
+        times = [
+            self.last_dispatch[host] + self.min_interval
+            for host in self.queues
+            if host in self.last_dispatch and self.in_flight.get(host, 0) < self.max_per_host
+        ]
+        return min(times, default=None)
+
+    def on_lease(self, task, now=None):
+        """Account for a task handed out to a worker, including re-dispatched ones."""
+        now = time.time() if now is None else now
+        host = host_of(task["url"])
+        self.in_flight[host] = self.in_flight.get(host, 0) + 1
+        self.last_dispatch[host] = now
+        self.last_dispatch.move_to_end(host)
+
+    def release(self, task):
+        """Account for a task that is no longer in flight (acked or expired)."""
+        host = host_of(task["url"])
+        count = self.in_flight.get(host, 0) - 1
+        if count > 0:
+            self.in_flight[host] = count
+        else:
+            self.in_flight.pop(host, None)
@@ -0,0 +1,106 @@
+import os
+import hashlib
+import pyarrow.parquet as pq
+
+
+def resolve_id_column(schema):
+    """Find the column that holds the task id.
+
+    Task ids are the pandas index of the parquet file. A stored index column is
+    returned by name; a RangeIndex is returned as its metadata dict so ids can be
+    derived from row numbers.
+    """
+    pandas_metadata = schema.pandas_metadata or {}
+    index_columns = pandas_metadata.get("index_columns", [])
+    if index_columns:
+        return index_columns[0]
+    return {"kind": "range", "start": 0, "step": 1}
+
+
+def count_rows(parquet_path):
+    """Number of rows of a parquet file, read from its footer only."""
+    return pq.ParquetFile(parquet_path).metadata.num_rows
+
+
+def file_fingerprint(parquet_path):
+    """Identify a parquet file by its size and a hash of its footer.
+
+    The footer holds the schema and the row group metadata (row counts, offsets and
+    column statistics), so it changes whenever the data does, and it can be read with
+    a single seek instead of a full scan of the file.
+    """
+    size = os.path.getsize(parquet_path)
+    with open(parquet_path, "rb") as f:
+        f.seek(-8, os.SEEK_END)
+        tail = f.read(8)
+        if tail[4:] != b"PAR1":
+            raise ValueError(f"{parquet_path} is not a parquet file")
+        footer_length = int.from_bytes(tail[:4], "little")
+        f.seek(-8 - footer_length, os.SEEK_END)
+        footer = f.read(footer_length)
+    return f"{size}-{hashlib.md5(footer).hexdigest()}"
+
+
+class ParquetTaskSource:
+    """Streams tasks from parquet files using pyarrow record batches.
+
+    Files are opened only when the iteration reaches them, and only the url and id
+    columns of the row groups that overlap a pending range are read. Memory use is
+    bounded by one record batch no matter how large the dataset is.
+
+    Yields (parquet_file, row, task_id, url) tuples.
+    """
+
+    def __init__(self, parquet_folder, files_with_ranges, url_column="url", batch_size=8192):
+        self.parquet_folder = parquet_folder
+        self.files_with_ranges = files_with_ranges
+        self.url_column = url_column
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        for parquet_file, pending_ranges in self.files_with_ranges:
+            yield from self.iter_file(parquet_file, pending_ranges)
+
+    def iter_file(self, parquet_file, pending_ranges):
+        if not pending_ranges:
+            return
+        reader = pq.ParquetFile(os.path.join(self.parquet_folder, parquet_file))
+        id_column = resolve_id_column(reader.schema_arrow)
+        columns = [self.url_column]
+        if isinstance(id_column, str):
+            columns.append(id_column)
+
+        range_index = 0
+        row_group_start = 0
+        for row_group in range(reader.metadata.num_row_groups):
+            row_group_end = row_group_start + reader.metadata.row_group(row_group).num_rows
+            # Skip row groups that lie entirely in the completed part of the file
+            while range_index < len(pending_ranges) and pending_ranges[range_index][1] <= row_group_start:
+                range_index += 1
+            if range_index == len(pending_ranges):
+                return
+            if pending_ranges[range_index][0] >= row_group_end:
+                row_group_start = row_group_end
+                continue
+
+            batch_start = row_group_start
+            for batch in reader.iter_batches(batch_size=self.batch_size, row_groups=[row_group], columns=columns):
+                batch_end = batch_start + batch.num_rows
+                while range_index < len(pending_ranges) and pending_ranges[range_index][1] <= batch_start:
+                    range_index += 1
+                i = range_index
+                while i < len(pending_ranges) and pending_ranges[i][0] < batch_end:
+                    start = max(pending_ranges[i][0], batch_start)
+                    end = min(pending_ranges[i][1], batch_end)
+                    if start < end:
+                        chunk = batch.slice(start - batch_start, end - start)
+                        urls = chunk.column(self.url_column).to_pylist()
+                        if isinstance(id_column, str):
+                            ids = chunk.column(id_column).to_pylist()
+                        else:
+                            ids = [id_column["start"] + row * id_column["step"] for row in range(start, end)]
+                        for offset, (task_id, url) in enumerate(zip(ids, urls)):
+                            yield parquet_file, start + offset, task_id, url
+                    i += 1
+                batch_start = batch_end
+            row_group_start = row_group_end
@@ -0,0 +1,116 @@
+import os
+import json
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+# Upper bounds, in seconds, of the histogram buckets of every stage
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120)
+
+
+class StageHistogram:
+    """Fixed-bucket histogram of the durations of one stage."""
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Estimate of the q-quantile, interpolated linearly within its bucket."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+class StageStats:
+    """Per-stage histograms of every span timed in this process."""
+
+    def __init__(self):
+        self.histograms = {}
+
+    def observe(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = StageHistogram()
+        histogram.observe(seconds)
+
+    def summary(self):
+        return {stage: histogram.summary() for stage, histogram in sorted(self.histograms.items())}
+
+    def format_summary(self):
+        lines = [f"{'stage':<24}{'count':>8}{'mean':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}"]
+        for stage, s in self.summary().items():
+            lines.append(
+                f"{stage:<24}{s['count']:>8}{s['mean']:>9.3f}{s['p50']:>9.3f}{s['p90']:>9.3f}{s['p99']:>9.3f}{s['max']:>9.3f}"
+            )
+        return "\n".join(lines)
+
+    def write(self, path):
+        """Atomically write the summary to `path` as JSON."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"updated_at": time.time(), "stages": self.summary()}, f, indent=2)
+        os.replace(tmp_path, path)
+
+
+# Aggregate of all spans of this process
+stage_stats = StageStats()
+
+
+class StageTimer:
+    """Timing record of one URL, built from named spans.
+
+    Time spent in a span is added to `timings[stage]` and to the process-wide
+    `stage_stats`, also when the span is left through an exception or a cancellation.
+    """
+
+    def __init__(self, stats=stage_stats):
+        self.stats = stats
+        self.start = time.perf_counter()
+        self.timings = {}
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+        if self.stats is not None:
+            self.stats.observe(stage, seconds)
+
+    def finish(self):
+        """Record the time since the timer was created as the `total` stage."""
+        self.add("total", time.perf_counter() - self.start)
+        return self.timings
@@ -0,0 +1,136 @@
+import os
+import json
+import asyncio
+import aiohttp
+
+
+class PublisherClient:
+    """Single pooled HTTP transport between a worker and the job publisher.
+
+    All requests share one aiohttp session with keep-alive connections. Acks are
+    batched; a batch that cannot be delivered is appended to a local spool file,
+    and the spool is replayed in order before any newer ack once the publisher is
+    reachable again, so completed work is never dropped.
+    """
+
+    def __init__(self, task_address, result_address, worker_id, spool_path, ack_batch_size=32, ack_interval=1.0,
+                 timeout=10, logger=None):
+        self.task_address = task_address
+        self.result_address = result_address
+        # Other endpoints (/register, /heartbeat, /ws) live next to /task
+        self.base_address = task_address.rsplit("/task", 1)[0]
+        self.worker_id = worker_id
+        self.spool_path = spool_path
+        self.ack_batch_size = ack_batch_size
+        self.ack_interval = ack_interval
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.logger = logger
+
+        self.session = None
+        self.pending_acks = []
+        self.sending_acks = []  # batch being posted, not known to be received yet
+        self.ack_lock = asyncio.Lock()
+
+    def _log(self, message):
+        if self.logger:
+            self.logger.warning(message)
+        else:
+            print(message)
+
+    async def start(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=8, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(
+                connector=connector, headers={"X-Worker-Id": self.worker_id}, timeout=self.timeout
+            )
+
+    async def close(self):
+        await self.flush_acks()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def post_json(self, address, data):
+        """POST `data` to the publisher. Returns True if it answered 200."""
+        try:
+            async with self.session.post(address, json=data) as response:
+                return response.status == 200
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            self._log(f"Error while sending to {address}: {e}")
+            return False
+
+    async def lease(self, n):
+        """Lease up to n tasks. Returns an empty list when none are available or on errors."""
+        try:
+            async with self.session.get(self.task_address, params={"n": n}) as response:
+                if response.status == 200:
+                    return (await response.json())["tasks"]
+                self._log(f"Error fetching tasks: status {response.status}")
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            self._log(f"Error fetching tasks: {e}")
+        return []
+
+    # Acknowledgements
+    async def ack(self, ack):
+        self.pending_acks.append(ack)
+        if len(self.pending_acks) >= self.ack_batch_size:
+            await self.flush_acks()
+
+    async def flush_acks(self):
+        async with self.ack_lock:
+            acks, self.pending_acks = self.pending_acks, []
+            # Older spooled acks go first, so newer ones queue up behind them
+            if os.path.exists(self.spool_path):
+                self._spool(acks)
+                await self._replay_spool()
+            elif acks:
+                self.sending_acks = acks
+                try:
+                    if not await self.post_json(self.result_address, {"acks": acks}):
+                        self._spool(acks)
+                finally:
+                    self.sending_acks = []
+
+    def spool_pending(self):
+        """Spool the acks that have not been delivered, e.g. when the worker stops without a last flush.
+
+        Acks of a batch that was being posted are spooled too; the publisher ignores
+        acks it has already processed.
+        """
+        acks, self.sending_acks, self.pending_acks = self.sending_acks + self.pending_acks, [], []
+        self._spool(acks)
+
+    def _spool(self, acks):
+        if not acks:
+            return
+        os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+        with open(self.spool_path, "a") as f:
+            for ack in acks:
+                f.write(json.dumps(ack) + "\n")
+        self._log(f"Spooled {len(acks)} acknowledgements to {self.spool_path}")
+
+    async def _replay_spool(self):
+        with open(self.spool_path, "r") as f:
+            acks = [json.loads(line) for line in f if line.strip()]
+        sent = 0
+        while sent < len(acks):
+            batch = acks[sent:sent + self.ack_batch_size]
+            if not await self.post_json(self.result_address, {"acks": batch}):
+                break
+            sent += len(batch)
+        if sent == len(acks):
+            os.remove(self.spool_path)
+            self._log(f"Replayed {sent} spooled acknowledgements")
+        elif sent:
+            # Keep what is left, atomically
+            tmp_path = f"{self.spool_path}.tmp"
+            with open(tmp_path, "w") as f:
+                for ack in acks[sent:]:
+                    f.write(json.dumps(ack) + "\n")
+            os.replace(tmp_path, self.spool_path)
+
+    async def run(self):
+        """Flush pending acks, and retry the spool, every `ack_interval` seconds."""
+        while True:
+            await asyncio.sleep(self.ack_interval)
+            await self.flush_acks()
@@ -1,7 +1,7 @@
 import os
 import logging
-from bs4 import BeautifulSoup
-from PIL import Image, ImageDraw
+
+from mmstack_web_crawler.annotate import boxes_from_html, mark_boxes_on_screenshot
 
 import logging
 
@@ -48,32 +48,5 @@ def setup_logger(logname, loglevel, run_name='app'):
 
 def mark_box_on_screenshot(screenshot, html_content, screenshot_bbox=None):
     """Mark bounding boxes on the screenshot."""
-    if screenshot_bbox:
-        sx1, sy1, sx2, sy2 = screenshot_bbox[0], screenshot_bbox[1], screenshot_bbox[2], screenshot_bbox[3]
-    else:
-        # Default to the full screenshot
-        sx1, sy1, sx2, sy2 = 0, 0, screenshot.width, screenshot.height
-
-    image = screenshot.copy()
-    draw = ImageDraw.Draw(image)
-    soup = BeautifulSoup(html_content, "html.parser")
-
-    for element in soup.find_all():
-        bbox = element.get("__bbox__")
-        left, top, right, bottom = map(int, bbox.strip("()").split(",")) if bbox else (None, None, None, None)
-
-        if not all([left, top, right, bottom]):
-            continue
-        
-        if left == top == right == bottom == 0:  # The element does not have a bounding box
-            continue
-
-        # Check if the element is visible in the viewport
-        if not (top < sy2 and bottom > sy1 and left < sx2 and right > sx1):
-            continue
-
-        draw.rectangle([left, top, right, bottom], outline="red", width=2)
-        # add text: tag name
-        draw.text((left, top), element.name, fill="red")
-    
-    return image
\ No newline at end of file
+    boxes, tags = boxes_from_html(html_content)
+    return mark_boxes_on_screenshot(screenshot, boxes, tags, screenshot_bbox)
@@ -3,15 +3,23 @@ import time
 import json
 import asyncio
 import argparse
+import socket
 import aiohttp
+import psutil
 import traceback
+from collections import deque
 
 from playwright.async_api import Error
 
 
 from mmstack_web_crawler.utils import setup_logger
 from mmstack_web_crawler.persistence import FileStorage
-from mmstack_web_crawler.crawler import MMStackWebCrawler
+from mmstack_web_crawler.crawler import OUTCOME_STORAGE_ERROR
+from mmstack_web_crawler.browser_pool import BrowserPool
+from mmstack_web_crawler.memory import MemoryGovernor
+from mmstack_web_crawler.transport import PublisherClient
+from mmstack_web_crawler.timing import StageTimer, stage_stats
+from mmstack_web_crawler.interception import RequestBlocker, POLICY_PRESETS, interception_stats
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -19,13 +27,41 @@ def parse_args():
     parser.add_argument("--storage", type=str, default="data", help="Path to store the crawled data")
     parser.add_argument("--task_address", type=str, default="http://localhost:8000/task", help="Address of the task message queue")
     parser.add_argument("--result_address", type=str, default="http://localhost:8000/done", help="Address of the result message queue")
-    parser.add_argument("--max_pages", type=int, default=50, help="Maximum number of pages to crawl")
+    parser.add_argument("--max_pages", type=int, default=50, help="Maximum number of pages to crawl, split across the browsers")
+    parser.add_argument("--crawl_timeout", type=float, default=90, help="Seconds after which a crawl is cancelled and its page closed")
+    parser.add_argument("--settle_quiet", type=float, default=0.5, help="Seconds without DOM, network or layout activity after which a page is considered settled")
+    parser.add_argument("--settle_timeout", type=float, default=5, help="Longest wait, in seconds, for a page to settle after loading and after resizing")
+    parser.add_argument("--block_policy", type=str, default="balanced", choices=list(POLICY_PRESETS), help="Requests aborted during capture: none, ads and analytics, plus non-visual and oversized media, or plus all media and fonts")
+    parser.add_argument("--blocklist_file", type=str, default=None, help="File with additional domains to block, one per line")
+    parser.add_argument("--capture_mode", type=str, default="snapshot", choices=["snapshot", "mark"], help="Capture the DOM and its layout with one CDP DOMSnapshot call, or mark bounding boxes on the live page")
+    parser.add_argument("--plain_html", action="store_true", help="Save the HTML of snapshot captures without __bbox__ attributes")
+    parser.add_argument("--num_browsers", type=int, default=2, help="Number of browsers in the pool, recycled one at a time")
     parser.add_argument("--run_name", type=str, default=None, help="Name of the run")
-    parser.add_argument("--restart_interval", type=int, default=1000, help="Interval to restart the browser")
+    parser.add_argument("--worker_id", type=str, default=None, help="Id reported to the publisher, defaults to <hostname>-<pid>")
+    parser.add_argument("--restart_interval", type=int, default=0, help="Number of pages after which a browser is drained and restarted, 0 to only restart on memory")
+    parser.add_argument("--max_browser_rss", type=float, default=4096, help="MB of RSS of one browser's process tree at which it is recycled")
+    parser.add_argument("--max_rss_slope", type=float, default=64, help="MB per minute of sustained RSS growth at which a browser is recycled")
+    parser.add_argument("--memory_interval", type=float, default=10, help="Seconds between memory samples of the browsers")
+    parser.add_argument("--memory_window", type=float, default=300, help="Seconds of memory samples the growth is measured over")
+    parser.add_argument("--prefetch", type=int, default=32, help="Maximum number of tasks leased per request to the publisher")
+    parser.add_argument("--ack_batch_size", type=int, default=32, help="Number of acknowledgements sent per request to the publisher")
+    parser.add_argument("--ack_interval", type=float, default=1.0, help="Seconds between flushes of pending acknowledgements")
+    parser.add_argument("--transport", type=str, default="ws", choices=["ws", "http"], help="Receive tasks pushed over a WebSocket, or poll /task over HTTP")
+    parser.add_argument("--push_address", type=str, default=None, help="WebSocket address of the publisher, derived from --task_address by default")
+    parser.add_argument("--heartbeat_interval", type=float, default=10, help="Seconds between heartbeats to the publisher")
+    parser.add_argument("--timing_summary_interval", type=float, default=60, help="Seconds between exports of the per-stage timing summary")
+    parser.add_argument("--ack_spool", type=str, default=None, help="File keeping acknowledgements the publisher could not receive, defaults to <storage>/ack_spool_<worker_id>.jsonl")
 
     args = parser.parse_args()
     if not args.run_name:
         args.run_name = f"worker_{time.strftime('%Y%m%d-%H%M%S')}"
+    if not args.worker_id:
+        args.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    if not args.ack_spool:
+        args.ack_spool = os.path.join(args.storage, f"ack_spool_{args.worker_id}.jsonl")
+    args.publisher_address = args.task_address.rsplit("/task", 1)[0]
+    if not args.push_address:
+        args.push_address = args.publisher_address.replace("http://", "ws://", 1).replace("https://", "wss://", 1) + "/ws"
 
     return args
 
@@ -41,31 +77,123 @@ def handle_task_exception(loop, context):
         loop.stop()
 
 
-async def worker(task, crawler, storage):
-    async def send_with_timeout(message, timeout=10):
+class WorkerStatus:
+    """Capacity and health of this worker, reported to the publisher in heartbeats."""
+
+    def __init__(self, max_pages, window=300):
+        self.max_pages = max_pages
+        self.window = window
+        self.started = time.time()
+        self.pool = None
+        self.governor = None
+        self.task_source = None
+        self.completed = deque()  # finish times of recent pages
+
+    def page_done(self):
+        self.completed.append(time.time())
+
+    def pages_per_minute(self):
+        now = time.time()
+        while self.completed and now - self.completed[0] > self.window:
+            self.completed.popleft()
+        return len(self.completed) * 60 / max(1.0, min(self.window, now - self.started))
+
+    def browser_rss(self):
+        """RSS of the browser process trees, i.e. every process started by this worker."""
+        rss = 0
+        for child in psutil.Process().children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
+        return rss
+
+    def browsers(self):
+        return [browser.to_dict() for browser in self.pool.browsers] if self.pool else []
+
+    def draining_slots(self):
+        """Page slots of the browsers that are draining for a restart."""
+        return self.pool.draining_slots() if self.pool else 0
+
+    def free_slots(self):
+        if self.pool is None:
+            return 0
+        buffered = self.task_source.pending() if self.task_source else 0
+        return max(0, self.pool.free_slots() - buffered)
+
+    def to_dict(self):
+        return {
+            "worker_id": args.worker_id,
+            "max_pages": self.max_pages,
+            "free_slots": self.free_slots(),
+            "pages_open": self.pool.pages_open() if self.pool else 0,
+            "rss_bytes": self.browser_rss(),
+            "pages_per_minute": self.pages_per_minute(),
+            "draining_slots": self.draining_slots(),
+            "browsers": self.browsers(),
+            "memory_recycles": self.governor.recycles if self.governor else 0,
+            "interception": interception_stats.to_dict(),
+        }
+
+
+async def send_heartbeats():
+    while not await client.post_json(f"{client.base_address}/register", worker_status.to_dict()):
+        await asyncio.sleep(args.heartbeat_interval)
+    while True:
+        await asyncio.sleep(args.heartbeat_interval)
+        await client.post_json(f"{client.base_address}/heartbeat", worker_status.to_dict())
+
+
+async def export_stage_timings():
+    """Periodically write the per-stage timing summary of this worker next to its data."""
+    path = os.path.join(args.storage, f"stage_timings_{args.worker_id}.json")
+    while True:
+        await asyncio.sleep(args.timing_summary_interval)
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(args.result_address, json=message, timeout=timeout) as response:
-                    if response.status != 200:
-                        print(f"Error while sending message: {message}")
-        except asyncio.TimeoutError:
-            print(f"Timeout while sending message: {message}")
-        except aiohttp.ClientError as e:
-            print(f"Aiohttp error while sending message: {e}")
+            await asyncio.to_thread(stage_stats.write, path)
+        except OSError as e:
+            logger.error(f"Error while writing the stage timings: {e}")
+        logger.info(f"Stage timings:\n{stage_stats.format_summary()}")
+
 
+async def crawl(task, crawler):
     # Call the crawl_page function to process the URL
-    crawled_content = await crawler.crawl(task["url"], output_annotated_screenshot=False)
+    timer = StageTimer()
+    crawl_result = await crawler.crawl_with_outcome(task["url"], output_annotated_screenshot=False, timer=timer)
+    return crawl_result, timer
+
+
+async def worker(task, crawl_result, timer, storage):
+    """Store a crawled page and acknowledge its task; its browser slot has been given back already."""
+    crawled_content = crawl_result["content"]
+    data = {"id": task["id"], "url": task["url"], "content": crawled_content}
 
     # Send the result back to the server
+    saved = False
     if crawled_content:
-        await storage.save({
-            "id": task["id"],
-            "url": task["url"],
-            "content": crawled_content
-        })
-    await send_with_timeout({
+        with timer.span("storage"):
+            try:
+                await storage.save(data, timer=timer)
+                saved = True
+            except (OSError, ValueError) as e:
+                logger.error(f"Error while saving {task['url']}: {e}")
+                crawl_result["outcome"] = OUTCOME_STORAGE_ERROR
+    # The total covers storage too, and the record is written once it is final
+    timings = timer.finish()
+    if saved:
+        try:
+            await storage.save_timings(data, timings)
+        except OSError as e:
+            logger.error(f"Error while saving the timings of {task['url']}: {e}")
+    worker_status.page_done()
+    await client.ack({
         "id": task["id"],
+        "file": task["file"],
+        "row": task["row"],
         "type": "complete",
+        "outcome": crawl_result["outcome"],
+        "http_status": crawl_result["http_status"],
+        "timings": timings,
     })
 
 
@@ -74,44 +202,151 @@ def get_storage(storage):
     return FileStorage(base_path=os.path.join(storage, timestamp))
 
 
-async def fetch_job():
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(args.task_address) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    print("Error fetching task")
-                    return None
-    except aiohttp.ClientError as e:
-        print(f"Aiohttp error while fetching task: {e}")
-        return None
+class TaskPrefetcher:
+    """Local buffer of leased tasks, refilled in batches as crawler capacity frees up."""
+
+    def __init__(self, prefetch=32):
+        self.prefetch = prefetch
+        self.buffer = deque()
+
+    def pending(self):
+        return len(self.buffer)
+
+    async def get(self, free_slots):
+        if not self.buffer:
+            self.buffer.extend(await client.lease(max(1, min(self.prefetch, free_slots))))
+        return self.buffer.popleft() if self.buffer else None
 
 
+class PushTaskChannel:
+    """Receives tasks pushed by the publisher over a persistent WebSocket.
+
+    The worker grants credit for the slots it can fill, and the publisher pushes up to
+    that many tasks as soon as they are available. Credit that has not been used yet
+    is announced again after a reconnect. The socket is opened on the shared session
+    of the `PublisherClient`; acks still go over HTTP so that they can be spooled.
+    """
+
+    def __init__(self, address, prefetch=32, reconnect_delay=1.0):
+        self.address = address
+        self.prefetch = prefetch
+        self.reconnect_delay = reconnect_delay
+        self.buffer = asyncio.Queue()
+        self.credit = 0  # slots announced to the publisher that have not been filled yet
+        self.ws = None
+
+    async def run(self):
+        while True:
+            try:
+                async with client.session.ws_connect(self.address, heartbeat=30) as ws:
+                    self.ws = ws
+                    logger.info(f"Connected to {self.address}")
+                    if self.credit > 0:
+                        await ws.send_json({"type": "credit", "n": self.credit})
+                    async for message in ws:
+                        if message.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        data = message.json()
+                        if data["type"] == "tasks":
+                            self.credit -= len(data["tasks"])
+                            for task in data["tasks"]:
+                                self.buffer.put_nowait(task)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Error on the push channel: {e!r}")
+            except (ValueError, KeyError, TypeError) as e:
+                # A malformed frame; reconnect rather than let the channel die
+                print(f"Malformed message on the push channel: {e!r}")
+            finally:
+                self.ws = None
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def send(self, message):
+        if self.ws is None or self.ws.closed:
+            return False
+        try:
+            await self.ws.send_json(message)
+            return True
+        except (aiohttp.ClientError, ConnectionResetError) as e:
+            print(f"Error while sending on the push channel: {e}")
+            return False
+
+    def pending(self):
+        # Credit that has not been filled holds no task, so it does not take a slot
+        return self.buffer.qsize()
+
+    async def get(self, free_slots):
+        # Keep announced credit plus buffered tasks topped up to the free slots
+        wanted = min(self.prefetch, free_slots) - self.credit - self.buffer.qsize()
+        if wanted > 0:
+            self.credit += wanted
+            await self.send({"type": "credit", "n": wanted})
+        return await self.buffer.get()
+
 
 async def worker_main():
-    while True:
-        tasks = []
-
-        # Initialize the crawler
-        async with MMStackWebCrawler(logger=logger, headless=True, max_pages=args.max_pages) as crawler:
-            logger.info("Browser initialized.")
-            while len(tasks) < args.restart_interval:
-                # Wait for capacity
-                await crawler.wait_for_capacity()
-                # Receive a URL from the queue
-                task = await fetch_job()
+    await client.start()
+    background = set()  # tasks running for the worker's whole lifetime, cancelled on shutdown
+    if args.transport == "ws":
+        task_source = PushTaskChannel(args.push_address, args.prefetch)
+        background.add(asyncio.create_task(task_source.run()))
+    else:
+        task_source = TaskPrefetcher(args.prefetch)
+    background.add(asyncio.create_task(client.run()))
+    worker_status.task_source = task_source
+    background.add(asyncio.create_task(send_heartbeats()))
+    background.add(asyncio.create_task(export_stage_timings()))
+    extra_domains = []
+    if args.blocklist_file:
+        with open(args.blocklist_file) as f:
+            extra_domains = [line.strip().lower() for line in f if line.strip() and not line.startswith("#")]
+    request_blocker = RequestBlocker.from_preset(args.block_policy, extra_domains=extra_domains, logger=logger)
+    try:
+        async with BrowserPool(
+            args.num_browsers,
+            args.max_pages,
+            args.restart_interval,
+            logger=logger,
+            headless=True,
+            crawl_timeout=args.crawl_timeout,
+            settle_quiet=args.settle_quiet,
+            settle_timeout=args.settle_timeout,
+            request_blocker=request_blocker,
+            capture_mode=args.capture_mode,
+            bbox_html=not args.plain_html,
+        ) as pool:
+            logger.info("Browsers initialized.")
+            worker_status.pool = pool
+            governor = MemoryGovernor(
+                pool,
+                max_rss=args.max_browser_rss * 2 ** 20,
+                max_slope=args.max_rss_slope * 2 ** 20,
+                interval=args.memory_interval,
+                window=args.memory_window,
+                logger=logger,
+            )
+            worker_status.governor = governor
+            background.add(asyncio.create_task(governor.run()))
+            while True:
+                # Wait for a free slot in any browser that is not draining
+                await pool.wait_for_capacity()
+                # Receive a URL from the local buffer, leasing a new batch when it runs dry
+                task = await task_source.get(pool.free_slots())
                 if task is None:
                     logger.info("No more tasks. Waiting...")
                     await asyncio.sleep(3)
                     continue
-                logger.info("Task received: ", task)
-                # Call the crawl_page function to process the URL
-                task = asyncio.create_task(worker(task, crawler, storage))
-                tasks.append(task)
-            logger.info("Maximum taks per broweser reached. Waiting for tasks to complete...")
-            await asyncio.gather(*tasks)
-        logger.info("Restarting the browser...")
+                logger.info(f"Task received: {task}")
+                # Crawl the URL on the least loaded browser
+                await pool.submit(
+                    lambda crawler, task=task: crawl(task, crawler),
+                    after=lambda result, task=task: worker(task, *result, storage),
+                )
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        # Acks of the pages stored while the pool closed; whatever cannot be sent is spooled in __main__
+        await client.close()
 
 
 if __name__ == '__main__':
@@ -119,10 +354,24 @@ if __name__ == '__main__':
     logger = setup_logger("worker", loglevel="debug" if args.debug else "warning")
 
     storage = get_storage(args.storage)
+    worker_status = WorkerStatus(args.max_pages)
+    client = PublisherClient(
+        args.task_address,
+        args.result_address,
+        args.worker_id,
+        args.ack_spool,
+        ack_batch_size=args.ack_batch_size,
+        ack_interval=args.ack_interval,
+        logger=logger,
+    )
 
     print("Worker started. Waiting for jobs...")
 
     loop = asyncio.new_event_loop()
     loop.set_exception_handler(handle_task_exception)
-    loop.run_until_complete(worker_main())
-    loop.close()
+    try:
+        loop.run_until_complete(worker_main())
+    finally:
+        # However the loop stopped (Ctrl-C, handle_task_exception), keep the acks of completed pages
+        client.spool_pending()
+        loop.close()
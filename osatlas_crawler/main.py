@@ -7,8 +7,7 @@ import random
 import json
 import argparse
 from utils import extract_urls_from_cdx
-import psutil
-import time
+from moniter_mem import BrowserMemoryTracker
 def configLogging(loglevel):
     if loglevel == 'info':
         level = logging.INFO
@@ -51,6 +50,8 @@ def worker_function(args):
     wait_timeout = args[4]
     scrape_hover = args[5]
     loglevel = args[6]
+    max_browser_rss = args[7]
+    max_rss_slope = args[8]
     in_file = open(os.path.join(in_dir, f"{worker_num}.txt"), 'r', encoding='utf-8')
     out_file = open(os.path.join(in_dir, f"{worker_num}_out.txt"), 'a', encoding='utf-8')
     out_image_dir = os.path.join(in_dir, f"{worker_num}_images")
@@ -61,6 +62,7 @@ def worker_function(args):
     crawler = Crawler(driver_path, out_image_dir, out_mhtml_dir, width, height, wait_timeout, logger, draw_box=False,
                       scrape_hover=scrape_hover,
                       nogui=True)
+    memory = BrowserMemoryTracker(max_rss=max_browser_rss * 2 ** 20, max_slope=max_rss_slope * 2 ** 20)
     for i, url in enumerate(in_file):
         try:
             results = crawler.processURL(url.strip())
@@ -71,20 +73,19 @@ def worker_function(args):
         #     for result in results:
         #         out_file.write(json.dumps(result) + '\n')
         # out_file.flush()
+        finally:
+            # 只重启占用内存过多或持续增长的browser，防止内存泄漏；失败的URL也要检查
+            rss = memory.sample(crawler.driver.service.process.pid)
+            reason = memory.restart_reason()
+            if reason:
+                logger.info(f"Worker {worker_num} restarts its browser ({rss / 2 ** 20:.0f} MB): {reason}")
+                crawler.restart()
+                memory.reset()
 
         if i > 0 and i % 100 == 0:
             logger.info(f"Worker {worker_num} has processed {i} urls")
-            crawler.restart()  # 重新启动一下browser，防止内存泄漏
-            logger.info(f"Worker {worker_num} has restarted the browser")
     crawler.quit()
 
-def monitor_processes():
-    while True:
-        for proc in psutil.process_iter(['name', 'memory_percent']):
-            if proc.info['name'] == 'node' and proc.info['memory_percent'] > 8:  # 如果node进程占用超过5%的内存
-                proc.terminate()  # 尝试终止进程
-        time.sleep(60)  # 每分钟检查一次
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--cdx_file_path", type=str, default='/cpfs01/shared/public/wangyian/data/web_crawl/cleaned_urls_1.json', help='path to url json, please save as a list of urls')
@@ -99,12 +100,12 @@ if __name__ == "__main__":
     parser.add_argument("--wait_timeout", type=int, default=20)
     parser.add_argument("--scrape_hover", action='store_true')
     parser.add_argument("--loglevel", type=str, default='INFO')
+    parser.add_argument("--max_browser_rss", type=float, default=4096, help='MB of RSS of one browser at which it is restarted')
+    parser.add_argument("--max_rss_slope", type=float, default=64, help='MB per minute of sustained RSS growth at which a browser is restarted')
 
     args = parser.parse_args()
     # 创建一个进程池，指定最大进程数
     num_workers = args.num_workers
-    monitor_process = multiprocessing.Process(target=monitor_processes)
-    monitor_process.start()
     pool = multiprocessing.Pool(processes=num_workers)
 
     # 使用进程池并行执行任务
@@ -114,12 +115,10 @@ if __name__ == "__main__":
     os.makedirs(out_dir, exist_ok=True)
     random.seed(args.seed)
     split_task_files(cdx_file_path, out_dir, num_workers, url_st, args.num_urls)
-    args_list = [(i, out_dir, args.width, args.height, args.wait_timeout, args.scrape_hover, args.loglevel) for i in
-                 range(num_workers)]
+    args_list = [(i, out_dir, args.width, args.height, args.wait_timeout, args.scrape_hover, args.loglevel,
+                  args.max_browser_rss, args.max_rss_slope) for i in range(num_workers)]
     pool.map(worker_function, args_list)
     # 关闭进程池，等待所有进程完成
     pool.close()
     pool.join()
-    monitor_process.terminate()
-    monitor_process.join()
     print("All workers have finished")
@@ -1,52 +1,78 @@
+import os
+import sys
 import psutil
 import time
 import logging
 
+# Shared with the Playwright crawler, which lives next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mmstack_web_crawler.memory import process_tree_rss, rss_slope
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def get_node_processes():
-    return [p for p in psutil.process_iter(['pid', 'name', 'memory_percent']) if p.info['name'] == 'node']
+class BrowserMemoryTracker:
+    """Decides when one browser should be restarted, from the RSS of its own process tree.
 
-def kill_excess_processes(processes, threshold):
-    if len(processes) <= 1:
-        return
+    A restart is due once the tree uses more than `max_rss` bytes, or once it kept
+    growing by more than `max_slope` bytes per minute over the last `window` seconds.
+    """
 
-    total_memory = sum(p.info['memory_percent'] for p in processes)
-    if total_memory <= threshold:
-        return
+    def __init__(self, max_rss=4096 * 2 ** 20, max_slope=64 * 2 ** 20, window=300, min_samples=6):
+        self.max_rss = max_rss
+        self.max_slope = max_slope
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = []  # (timestamp, rss)
 
-    processes.sort(key=lambda x: x.info['memory_percent'])
-    
-    for process in processes[1:]:
-        try:
-            logging.info(f"Attempting to terminate process {process.pid} (memory: {process.info['memory_percent']:.2f}%)")
-            process.terminate()
-            process.wait(timeout=3)
-        except psutil.NoSuchProcess:
-            logging.info(f"Process {process.pid} no longer exists")
-        except psutil.TimeoutExpired:
-            logging.warning(f"Process {process.pid} did not terminate, forcing kill")
-            try:
-                process.kill()
-            except psutil.NoSuchProcess:
-                logging.info(f"Process {process.pid} no longer exists after kill attempt")
-
-def monitor_node_processes(threshold=30.0, interval=60):
+    def reset(self):
+        self.samples = []
+
+    def sample(self, pid, now=None):
+        now = time.time() if now is None else now
+        rss = process_tree_rss(pid)
+        self.samples.append((now, rss))
+        self.samples = [(t, r) for t, r in self.samples if now - t <= self.window]
+        return rss
+
+    def slope(self):
+        """Least squares growth of the RSS, in bytes per minute."""
+        return rss_slope(self.samples)
+
+    def restart_reason(self):
+        if not self.samples:
+            return None
+        rss = self.samples[-1][1]
+        if self.max_rss and rss > self.max_rss:
+            return f"RSS {rss / 2 ** 20:.0f} MB above {self.max_rss / 2 ** 20:.0f} MB"
+        if (
+            self.max_slope
+            and len(self.samples) >= self.min_samples
+            and self.samples[-1][0] - self.samples[0][0] >= self.window / 2
+            and self.slope() > self.max_slope
+        ):
+            return f"RSS growing {self.slope() / 2 ** 20:.1f} MB/min"
+        return None
+
+
+def get_browser_trees():
+    """chromedriver processes, each the root of one crawler's browser process tree."""
+    return [p for p in psutil.process_iter(['pid', 'name']) if p.info['name'] == 'chromedriver']
+
+def report_browser_memory(interval=60):
+    # Only reports; each crawler restarts its own browser based on the same measurements
     while True:
         try:
-            node_processes = get_node_processes()
-            total_memory = sum(p.info['memory_percent'] for p in node_processes)
-            logging.info(f"Total node processes: {len(node_processes)}, Total memory: {total_memory:.2f}%")
+            trees = get_browser_trees()
+            sizes = [process_tree_rss(p.pid) for p in trees]
+            logging.info(f"Browsers: {len(trees)}, Total RSS: {sum(sizes) / 2 ** 20:.0f} MB")
+            for process, rss in sorted(zip(trees, sizes), key=lambda x: -x[1]):
+                logging.info(f"  chromedriver {process.pid}: {rss / 2 ** 20:.0f} MB")
 
-            if total_memory > threshold:
-                kill_excess_processes(node_processes, threshold)
-            
             time.sleep(interval)
         except Exception as e:
             logging.error(f"An error occurred: {str(e)}")
             time.sleep(interval)
 
 if __name__ == "__main__":
-    logging.info("Starting node process monitor...")
-    monitor_node_processes()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logging.info("Starting browser memory report...")
+    report_browser_memory()